@@ -0,0 +1,92 @@
+import os
+import time
+import glob
+
+# rows written to one chunk file at most
+CHUNK_ROWS = 10000
+# compression of the chunk files, None keeps them uncompressed so replays read them without copying
+ARCHIVE_COMPRESSION = 'zstd'
+# columns kept as text, every other column is a number
+STRING_FIELDS = ('fileName', 'weather', 'inspectionId', 'imagename', 'vehicle', 'detections', 'entryId')
+
+# pyarrow is imported only by the archive, the drone runs without it when nothing is archived
+def getArrow():
+    import pyarrow
+    import pyarrow.ipc
+    return pyarrow
+
+# archive of one flight, every table is a folder of chunk files in the arrow ipc format, each holding up to CHUNK_ROWS rows,
+# a chunk is complete once written so a crash loses at most the rows still buffered
+class FlightArchive:
+    def __init__(self, directory, inspectionId, chunkRows=CHUNK_ROWS, compression=ARCHIVE_COMPRESSION, chunkName=None):
+        self.directory = os.path.join(directory, inspectionId)
+        self.chunkRows = chunkRows
+        self.compression = compression
+        # names a chunk by its rows, so writing the same rows again replaces the chunk, None names it by the time
+        # of its first row and the writing process
+        self.chunkName = chunkName
+        self.rows = {}
+
+    # adds a row, a dict of column values, to the table
+    def append(self, table, row):
+        rows = self.rows.setdefault(table, [])
+        rows.append(row)
+        if len(rows) >= self.chunkRows:
+            self.flushTable(table)
+
+    def flushTable(self, table):
+        rows = self.rows.pop(table, [])
+        if not rows:
+            return
+        pa = getArrow()
+        folder = os.path.join(self.directory, table)
+        os.makedirs(folder, exist_ok=True)
+        # rows may miss columns, the chunk takes every column seen, time in ns, text or numbers
+        names = list(dict.fromkeys(name for row in rows for name in row))
+        schema = pa.schema([(name, pa.int64() if name == 'time' else pa.string() if name in STRING_FIELDS else pa.float64()) for name in names])
+        batch = pa.RecordBatch.from_pylist(rows, schema=schema)
+        # chunks are named by the time of their first row, so sorting the names sorts the rows
+        name = self.chunkName(rows) if self.chunkName is not None else str(rows[0].get('time', time.time_ns())) + '-' + str(os.getpid())
+        path = os.path.join(folder, name + '.arrow')
+        options = pa.ipc.IpcWriteOptions(compression=self.compression)
+        with pa.OSFile(path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, batch.schema, options=options) as writer:
+            writer.write_batch(batch)
+        os.replace(path + '.tmp', path)
+
+    def flush(self):
+        for table in list(self.rows):
+            self.flushTable(table)
+
+# inspection ids of the flights found in the archive
+def listFlights(directory):
+    return sorted(name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name)))
+
+# record batches of the table of the flight read from memory mapped chunk files, only the given columns when set
+def readBatches(directory, inspectionId, table, columns=None):
+    pa = getArrow()
+    for path in sorted(glob.glob(os.path.join(directory, inspectionId, table, '*.arrow'))):
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                yield batch.select([name for name in columns if name in batch.schema.names]) if columns is not None else batch
+
+# the whole table of the flight at once, for analyses over many flights, columns missing from a chunk are null in its rows
+def readFlight(directory, inspectionId, table, columns=None):
+    pa = getArrow()
+    tables = [pa.Table.from_batches([batch]) for batch in readBatches(directory, inspectionId, table, columns)]
+    return pa.concat_tables(tables, promote_options='default') if tables else pa.table({})
+
+# streams the rows of the table of the flight back as dicts, speed times faster than they were recorded
+# following their time column in ns, or as fast as possible when speed is None
+def replay(directory, inspectionId, table, speed=None, columns=None):
+    start = None
+    for batch in readBatches(directory, inspectionId, table, columns if columns is None or 'time' in columns else columns + ['time']):
+        for row in batch.to_pylist():
+            if speed is not None:
+                if start is None:
+                    start = (time.monotonic(), row['time'])
+                wait = start[0] + (row['time'] - start[1]) / 1e9 / speed - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            yield row
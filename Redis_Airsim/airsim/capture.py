@@ -0,0 +1,231 @@
+import math
+import time
+import queue
+import threading
+
+# marks the end of the capture for the encode and publish stages
+STOP = object()
+# the timings stream keeps about this many entries
+TIMINGS_LENGTH = 10000
+# seconds between two checks whether the consumers made room for spilled frames
+REPLAY_INTERVAL = 0.5
+
+# time in seconds between two frames so that they overlap by the given fraction on the ground
+def overlapInterval(speed, altitude, overlap, fov):
+    footprint = 2 * abs(altitude) * math.tan(math.radians(fov) / 2)
+    if speed <= 0 or footprint <= 0:
+        return math.inf
+    return footprint * (1 - overlap) / speed
+
+# captures, encodes and publishes frames to the inspectiondata stream as three pipelined stages,
+# the consumers delete the frames they processed and the stream never grows over memoryBudget bytes,
+# frames coming while it is full wait in the spill log on disk, or in the queues when there is none
+class CaptureEngine:
+    def __init__(self, conn, grab, encode, inspectionId, memoryBudget, fps=0.5, overlap=None, motion=None, fov=90, queueSize=8, dropPolicy='oldest', vehicle='', spill=None, join=None):
+        # grab() returns a captured frame, encode(frame) returns the fields of its stream entry
+        # and motion(frame) returns the (speed, altitude) of the drone when it was captured, used only when overlap is set,
+        # join(clock) returns more fields of the entry for the time.monotonic() at which the frame was taken, like the telemetry
+        self.conn = conn
+        self.grab = grab
+        self.encode = encode
+        self.join = join
+        self.inspectionId = inspectionId
+        # name of the AirSim vehicle, every entry is tagged with it when several drones fly
+        self.vehicle = vehicle
+        self.prefix = inspectionId + ('_' + vehicle if vehicle else '')
+        self.memoryBudget = memoryBudget
+        self.spill = spill
+        # bytes used by the stream when the last frames were published
+        self.backlog = 0
+        self.fps = fps
+        self.overlap = overlap
+        self.motion = motion
+        self.fov = fov
+        # 'oldest' throws away the oldest queued frame when a queue is full, 'newest' the incoming one
+        self.dropPolicy = dropPolicy
+        self.encodeQueue = queue.Queue(queueSize)
+        self.publishQueue = queue.Queue(queueSize)
+        self.captured = 0
+        self.published = 0
+        self.dropped = 0
+        self.reportedDrops = 0
+        self.spilled = 0
+
+    # time to wait until the next frame is captured
+    def nextInterval(self, frame):
+        interval = 1 / self.fps
+        if self.overlap is not None and self.motion is not None:
+            speed, altitude = self.motion(frame)
+            interval = min(interval, overlapInterval(speed, altitude, self.overlap, self.fov))
+        return interval
+
+    # puts the item to the queue, dropping a frame according to the policy when the queue is full
+    def offer(self, q, item):
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        self.dropped += 1
+        if self.dropPolicy == 'newest':
+            return
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put(item)
+
+    def encodeStage(self):
+        while True:
+            item = self.encodeQueue.get()
+            if item is STOP:
+                self.publishQueue.put(STOP)
+                return
+            frame, captureTime, captureClock, captureSeconds = item
+            try:
+                start = time.perf_counter()
+                fields = self.encode(frame)
+                if self.join is not None:
+                    fields = fields + self.join(captureClock)
+                self.offer(self.publishQueue, (fields, captureTime, captureSeconds, time.perf_counter() - start))
+            except Exception as e:
+                print("Failed to encode frame: " + str(e))
+
+    # queues an entry of the timings stream with the seconds every stage took summed over the frames
+    def addTimings(self, pipe, frames, timings):
+        fields = sum([[stage, round(seconds * 1000, 3)] for stage, seconds in timings.items()], [])
+        pipe.execute_command('xadd', 'timings', 'MAXLEN', '~', TIMINGS_LENGTH, '*', 'frames', frames, *fields)
+
+    # takes everything waiting in the publish queue, waits for at least one entry unless spilled frames wait for room
+    def takeEntries(self, stopping):
+        if stopping:
+            time.sleep(REPLAY_INTERVAL)
+            return []
+        try:
+            if self.spill is not None and self.spill.pending():
+                entries = [self.publishQueue.get(timeout=REPLAY_INTERVAL)]
+            else:
+                entries = [self.publishQueue.get()]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                entries.append(self.publishQueue.get_nowait())
+            except queue.Empty:
+                return entries
+
+    # asks redis how many bytes the stream uses until the consumers got it under the budget
+    def waitForRoom(self):
+        while self.backlog >= self.memoryBudget:
+            time.sleep(REPLAY_INTERVAL)
+            self.backlog = self.conn.execute_command('memory', 'usage', 'inspectiondata') or 0
+
+    # spilled frames which fit into the stream again, oldest first
+    def replay(self):
+        frames = []
+        room = self.memoryBudget - self.backlog
+        while room > 0:
+            fields = self.spill.pop()
+            if fields is None:
+                break
+            frames.append(fields)
+            room -= sum(len(v) if isinstance(v, (bytes, str)) else 8 for v in fields)
+        return frames
+
+    # sends all queued frames to redis in one pipeline round trip, together with the timings of their stages,
+    # the time the previous round trip took and a check of the memory used by the stream
+    def publishStage(self):
+        pipe = self.conn.pipeline(transaction=False)
+        stopping = False
+        lastRoundTrip = None
+        while not stopping or (self.spill is not None and self.spill.pending()):
+            timings = {'capture': 0.0, 'encode': 0.0}
+            frames = []
+            for entry in self.takeEntries(stopping):
+                if entry is STOP:
+                    stopping = True
+                    continue
+                fields, captureTime, captureSeconds, encodeSeconds = entry
+                timings['capture'] += captureSeconds
+                timings['encode'] += encodeSeconds
+                # frames are numbered before they may be spilled, so the numbers follow the order of the capture
+                self.published += 1
+                imagename = self.prefix + "_" + str(self.published) + '.jpg'
+                tags = ['vehicle', self.vehicle] if self.vehicle else []
+                frames.append(['imagename', imagename, 'inspectionId', self.inspectionId, 'seq', self.published,
+                               'captureTime', repr(captureTime), *tags, *sum(fields, [])])
+            captured = len(frames)
+
+            # frames sent without going through the spill log, they are spilled when sending them fails
+            unspilled = frames
+            if self.spill is None:
+                self.waitForRoom()
+            elif self.spill.pending() or self.backlog >= self.memoryBudget:
+                # older frames still wait on disk or the stream is full, the new ones queue up behind them
+                for fields in frames:
+                    self.spill.append(fields)
+                self.spill.flush()
+                self.spilled += len(frames)
+                unspilled = []
+                frames = self.replay()
+
+            for fields in frames:
+                pipe.execute_command('xadd', 'inspectiondata', '*', *fields)
+            if captured:
+                self.addTimings(pipe, captured, timings)
+            if lastRoundTrip is not None:
+                self.addTimings(pipe, lastRoundTrip[0], {'xadd': lastRoundTrip[1]})
+                lastRoundTrip = None
+            if self.dropped > self.reportedDrops:
+                pipe.execute_command('xadd', 'timings', 'MAXLEN', '~', TIMINGS_LENGTH, '*', 'dropped', self.dropped - self.reportedDrops)
+                self.reportedDrops = self.dropped
+            pipe.execute_command('memory', 'usage', 'inspectiondata')
+            try:
+                start = time.perf_counter()
+                res = pipe.execute()
+                self.backlog = res[-1] or 0
+                if frames:
+                    lastRoundTrip = (len(frames), time.perf_counter() - start)
+                if self.spill is not None:
+                    self.spill.commit()
+            except Exception as e:
+                print("Failed to publish frames: " + str(e))
+                pipe.reset()
+                # the frames replayed from the spill log go back to it and the others are spilled behind them,
+                # so a failed round trip delays them instead of losing them
+                if self.spill is not None:
+                    self.spill.rewind()
+                    for fields in unspilled:
+                        self.spill.append(fields)
+                    self.spill.flush()
+                    self.spilled += len(unspilled)
+                    # once the capture is over the frames left on disk are replayed by the next run
+                    if stopping:
+                        break
+        if self.spill is not None:
+            self.spill.close()
+
+    # captures frames at the configured rate while keepRunning() is true, then waits for the queued frames to be published
+    def run(self, keepRunning):
+        stages = [threading.Thread(target=self.encodeStage), threading.Thread(target=self.publishStage)]
+        for stage in stages:
+            stage.start()
+
+        nextCapture = time.monotonic()
+        try:
+            while keepRunning():
+                # wall clock time of the capture, the gear measures the latency of the frame from it
+                captureTime = time.time()
+                start = time.monotonic()
+                frame = self.grab()
+                end = time.monotonic()
+                # the frame is taken somewhere during the grab, its middle is the best guess
+                self.offer(self.encodeQueue, (frame, captureTime, (start + end) / 2, end - start))
+                self.captured += 1
+                nextCapture = max(nextCapture + self.nextInterval(frame), time.monotonic())
+                time.sleep(max(0, nextCapture - time.monotonic()))
+        finally:
+            self.encodeQueue.put(STOP)
+            for stage in stages:
+                stage.join()
+        print("Captured " + str(self.captured) + " frames, published " + str(self.published) + ", dropped " + str(self.dropped) + ", spilled " + str(self.spilled))
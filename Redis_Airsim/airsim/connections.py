@@ -0,0 +1,85 @@
+import time
+import random
+import asyncio
+import redis
+import redis.asyncio
+
+# seconds it took every waited for connection or readiness check to succeed, by name
+readyTimes = {}
+# one redis connection pool per address, redis-py recreates the pool after a fork so every process gets its own sockets
+redisPools = {}
+
+# calls check() until it returns something truthy and returns it, waiting with exponential backoff and jitter in between
+# and treating exceptions as not ready yet, raises TimeoutError once timeout seconds have passed
+def waitFor(check, name, timeout=None, initialDelay=0.05, maxDelay=5.0):
+    start = time.monotonic()
+    delay = initialDelay
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            result = check()
+            if result:
+                readyTimes[name] = time.monotonic() - start
+                if attempts > 1:
+                    print(name + " ready after " + str(round(readyTimes[name], 2)) + " s")
+                return result
+        except Exception as e:
+            if attempts == 1:
+                print(name + " is not ready yet: " + str(e))
+        elapsed = time.monotonic() - start
+        if timeout is not None and elapsed >= timeout:
+            raise TimeoutError(name + " was not ready after " + str(timeout) + " s")
+        sleep = random.uniform(delay / 2, delay)
+        if timeout is not None:
+            sleep = min(sleep, timeout - elapsed)
+        time.sleep(sleep)
+        delay = min(delay * 2, maxDelay)
+
+# waitFor for coroutines, check() returns an awaitable and the waits between the checks let the other coroutines run
+async def waitForAsync(check, name, timeout=None, initialDelay=0.05, maxDelay=5.0):
+    start = time.monotonic()
+    delay = initialDelay
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            result = await check()
+            if result:
+                readyTimes[name] = time.monotonic() - start
+                if attempts > 1:
+                    print(name + " ready after " + str(round(readyTimes[name], 2)) + " s")
+                return result
+        except Exception as e:
+            if attempts == 1:
+                print(name + " is not ready yet: " + str(e))
+        elapsed = time.monotonic() - start
+        if timeout is not None and elapsed >= timeout:
+            raise TimeoutError(name + " was not ready after " + str(timeout) + " s")
+        sleep = random.uniform(delay / 2, delay)
+        if timeout is not None:
+            sleep = min(sleep, timeout - elapsed)
+        await asyncio.sleep(sleep)
+        delay = min(delay * 2, maxDelay)
+
+# redis client using the shared connection pool of the address
+def getRedis(host="localhost", port=6379):
+    if (host, port) not in redisPools:
+        redisPools[(host, port)] = redis.ConnectionPool(host=host, port=port)
+    return redis.Redis(connection_pool=redisPools[(host, port)])
+
+# redis client which answered a ping
+def pingRedis(host="localhost", port=6379):
+    conn = getRedis(host, port)
+    conn.ping()
+    return conn
+
+# asyncio redis client which answered a ping
+async def pingRedisAsync(host="localhost", port=6379):
+    conn = redis.asyncio.Redis(host=host, port=port)
+    try:
+        await conn.ping()
+    except Exception:
+        await conn.aclose()
+        raise
+    return conn
@@ -3,91 +3,160 @@ import cv2
 import io
 import time
 import math
-import redis
+import asyncio
 import airsim
-import datetime
 import numpy as np
 from PIL import Image 
 import binascii
 import atexit
 
 from types import TracebackType
-from multiprocessing import Process
-from influxdb_client import Point
 from paho.mqtt import client as mqtt_client
+from capture import CaptureEngine
+from spill import SegmentLog
+from telemetry import TelemetryWriter
+from metrics import MetricsExporter
+from archive import FlightArchive
+from connections import readyTimes, waitFor, waitForAsync, pingRedis, pingRedisAsync
+from planner import lawnmowerWaypoints, sweepSpacing, flyWaypoints
+
+# how the frames are sent to the inspectiondata stream: 'jpeg' encodes them on the drone, 'raw' sends the pixels
+# and 'png' sends the frames already compressed by AirSim
+FRAME_ENCODING = 'jpeg'
+# size (width, height) the frames are downscaled to before sending, (320, 320) is the input size of the model
+# and None keeps the captured size, frames compressed by AirSim are never downscaled
+FRAME_SIZE = None
+# frames captured per second, the default matches the old fixed 2 second sleep
+CAPTURE_FPS = 0.5
+# overlap (0-1) of consecutive frames on the ground, when set the capture rate follows the speed and altitude of the drone
+CAPTURE_OVERLAP = None
+# field of view of the camera in degrees
+CAMERA_FOV = 90
+# frames waiting to be encoded or published before the capture starts dropping them
+CAPTURE_QUEUE_SIZE = 8
+# which frame is dropped when a queue is full, 'oldest' or 'newest'
+CAPTURE_DROP_POLICY = 'oldest'
+# overlap (0-1) of neighbouring sweeps when their spacing is derived from the camera footprint
+SURVEY_OVERLAP = 0.2
+# waypoints flown by one moveOnPathAsync call, None flies the whole survey in one call
+PATH_CHUNK_SIZE = None
+# bytes the inspectiondata stream may use, the consumers delete what they processed and new frames wait until there is room
+STREAM_MEMORY_BUDGET = 64 * 1024 * 1024
+# directory the frames waiting for room are spilled to, every vehicle gets its own folder in it, None blocks the publisher
+# until there is room, so the capture queues fill up and frames are dropped by CAPTURE_DROP_POLICY meanwhile
+SPILL_DIR = 'spill'
+# size of one file of the spill log
+SPILL_SEGMENT_BYTES = 64 * 1024 * 1024
+# corners of the area surveyed by a single drone
+SURVEY_AREA = np.array([[0, 0], [-100, 0], [0, -80], [-100, -80]])
+# seconds to wait for Redis, MQTT and AirSim before giving up, None waits forever
+CONNECT_TIMEOUT = None
+# seconds between two telemetry samples
+TELEMETRY_INTERVAL = 0.1
+# telemetry samples are sent to influx together once this many are buffered or the oldest one is this many seconds old
+TELEMETRY_BATCH_SIZE = 50
+TELEMETRY_FLUSH_INTERVAL = 1.0
+# seconds between two exports of the pipeline latency histograms to influx
+METRICS_INTERVAL = 10.0
+# directory the telemetry of every inspection is archived to for replays, None archives nothing
+ARCHIVE_DIR = 'archive'
+# seconds between a frame and the telemetry sample it is joined with at most, frames without any get no telemetry
+TELEMETRY_MAX_GAP = 0.5
+# fields of the telemetry at the moment a frame was taken stored with the frame, when the telemetry is captured as well
+FRAME_TELEMETRY_FIELDS = ['speed_x', 'speed_y', 'speed_z', 'speed',
+                          'acceleration_x', 'acceleration_y', 'acceleration_z',
+                          'altitude',
+                          'orientation_quaternion_w', 'orientation_quaternion_x', 'orientation_quaternion_y', 'orientation_quaternion_z']
+# fields of every telemetry sample sent to influx
+TELEMETRY_FIELDS = ['speed_x', 'speed_y', 'speed_z', 'speed',
+                    'acceleration_x', 'acceleration_y', 'acceleration_z', 'acceleration',
+                    'altitude', 'longtitude', 'latitude',
+                    'orientation_quaternion_w', 'orientation_quaternion_x', 'orientation_quaternion_y', 'orientation_quaternion_z',
+                    'x_coordinate', 'y_coordinate', 'z_coordinate',
+                    'air_pressure', 'temperature', 'air_density',
+                    'gravitational_force_x', 'gravitational_force_y', 'gravitational_force_z', 'gravitational_force',
+                    'magnetic_field_strength_x', 'magnetic_field_strength_y', 'magnetic_field_strength_z', 'magnetic_field_strength']
 
 # connects to mqtt
 def connect_mqtt():
     tempClient = mqtt_client.Client()
-    try:
-        tempClient.connect("localhost", 1883)
-    except:
-        print("Can't connect to MQTT at localhost:1883")
-        connected = False
-        while not connected:
-            try:
-                tempClient.connect("localhost", 1883)
-                connected = True
-            except:
-                pass
+    waitFor(lambda: tempClient.connect("localhost", 1883) == 0, "MQTT at localhost:1883", CONNECT_TIMEOUT)
     return tempClient
 
-# sends data to influx 
-def send(data, client):
-    p = Point("environment") \
-        .tag("clientId", "drone") \
-        .time(datetime.datetime.utcnow())
-
-    for key, value in data.items():
-        p = p.field(key, float(value))
-        
-    client.publish("iot_center", p.to_line_protocol())
-
 # connects to redis
 def connect_redis():
-    t = None
-    try:
-        tempConn = redis.Redis(host="localhost", port=6379)
-        t = tempConn.ping()
-    except: 
-        print("Can't connect to Redis at localhost:6379")
-        while t is None:
-            try:
-                tempConn = redis.Redis(host="localhost", port=6379)
-                t = tempConn.ping()
-            except:
-                pass
-    return tempConn
+    return waitFor(lambda: pingRedis("localhost", 6379), "Redis at localhost:6379", CONNECT_TIMEOUT)
+
 # set the camera pose of the drone while flying
-def setCameraPose(client):
+def setCameraPose(client, vehicle=''):
     camera_pose = airsim.Pose(airsim.Vector3r(0, 0, 0), airsim.to_quaternion(-1.5708, 0, 0))
-    client.simSetCameraPose("1", camera_pose)
+    client.simSetCameraPose("1", camera_pose, vehicle_name=vehicle)
 
-# add real time images captured by drone to the redis stream
-def addToStream(conn, img_rgb, imagename, maxImages):
-    _, data = cv2.imencode('.jpg', img_rgb) 
-    storedimg = data.tobytes()
+# encodes a frame captured by the drone into the fields of its inspectiondata stream entry
+def encodeFrame(frame, encoding=FRAME_ENCODING):
     iteration = [] 
     iteration.append(['weather','Sunny'])
     iteration.append(['windSpeed', 5])
-    iteration.append(['imagename',imagename])
+    iteration.append(['encoding',encoding])
+    if encoding == 'png':
+        # already compressed by AirSim, sent as it is
+        storedimg = frame
+    else:
+        if FRAME_SIZE is not None:
+            frame = cv2.resize(frame, FRAME_SIZE, interpolation=cv2.INTER_AREA)
+        if encoding == 'raw':
+            storedimg = frame.tobytes()
+            iteration.append(['width', frame.shape[1]])
+            iteration.append(['height', frame.shape[0]])
+        else:
+            _, data = cv2.imencode('.jpg', frame) 
+            storedimg = data.tobytes()
     iteration.append(['image',storedimg])
     iteration.append(['isDone','0'])
-    try:
-        conn.execute_command('xadd', 'inspectiondata', 'MAXLEN', '~', str(maxImages), '*', *sum(iteration, []))
-    except:
-        print("tak ses pica")
-    #print(res)
+    return iteration
 
-# get the images of the land taken by drone
-def getRealTimeImage(client):
+# get the images of the land taken by drone, compressed frames come back as png bytes
+def getRealTimeImage(client, compress=False, vehicle=''):
     #simImage = client.simGetImage("1", airsim.ImageType.Scene)
-    simImages = client.simGetImages([airsim.ImageRequest(1, airsim.ImageType.Scene, False, False),])
+    simImages = client.simGetImages([airsim.ImageRequest(1, airsim.ImageType.Scene, False, compress),], vehicle_name=vehicle)
     simImage = simImages[0]
-    img1d = np.fromstring(simImage.image_data_uint8, dtype=np.uint8)
+    if compress:
+        return simImage.image_data_uint8
+    img1d = np.frombuffer(simImage.image_data_uint8, dtype=np.uint8)
     img_rgb = img1d.reshape(simImage.height, simImage.width, 3)
     return img_rgb
         
+# captures a frame together with the state of the drone at that moment
+def captureFrame(client, compress=False, vehicle=''):
+    state = client.getMultirotorState(vehicle_name=vehicle)
+    return getRealTimeImage(client, compress, vehicle), state
+
+# fields of the telemetry of the drone at the given time.monotonic(), nothing when no sample is close enough
+def frameTelemetry(ring, clock):
+    sample = ring.at(clock, TELEMETRY_MAX_GAP)
+    if sample is None:
+        return []
+    return [[field, sample[field]] for field in FRAME_TELEMETRY_FIELDS if not math.isnan(sample[field])]
+
+# speed and altitude above the take off point of the drone
+def getMotion(state):
+    kinematics = state.kinematics_estimated
+    return kinematics.linear_velocity.get_length(), -kinematics.position.z_val
+
+# pose of the drone stored with every frame, so the gear can place its detections on the map
+def poseFields(state):
+    kinematics = state.kinematics_estimated
+    _, _, yaw = airsim.to_eularian_angles(kinematics.orientation)
+    pose = []
+    pose.append(['positionX', kinematics.position.x_val])
+    pose.append(['positionY', kinematics.position.y_val])
+    pose.append(['positionZ', kinematics.position.z_val])
+    pose.append(['yaw', yaw])
+    pose.append(['latitude', state.gps_location.latitude])
+    pose.append(['longitude', state.gps_location.longitude])
+    pose.append(['gpsAltitude', state.gps_location.altitude])
+    return pose
+
 # coordinates system for redis 
 def convertToMap(data):
     if isinstance(data, bytes):  return data.decode('ascii')
@@ -95,212 +164,244 @@ def convertToMap(data):
     if isinstance(data, tuple):  return map(convertToMap, data)
     return data
 
-def flyOverRectangleArea(client, corners, spacing, height, velocity):
-    # sorts corners according to their x coordinate 
-    corners = corners[corners[:, 0].argsort()] 
-    # sorts for the case where the recatangle is parallel to teh x axis, according to teir y coordinate
-    if corners[0][0] == corners[1][0]:
-        if corners[0][1] > corners[1][1]:
-            t = corners[0][1]
-            corners[0][1] = corners[1][1]
-            corners[1][1] = t
-        if corners[2][1] > corners[3][1]:
-            t = corners[2][1]
-            corners[2][1] = corners[3][1]
-            corners[3][1] = t
-    #this means that that the croner on the first set of cords is opposite to the one on the last set of cords
-
-    # calculates the vector pointing from the first set of cords to the second one
-    firstVector = [(corners[1][0] - corners[0][0]), (corners[1][1] - corners[0][1])]
-    # calculates the vector pointing from the first set of cords to the third one
-    secondVector = [(corners[2][0]-corners[0][0]), (corners[2][1]-corners[0][1])]
-    # calculates the length of the first vector 
-    length = math.sqrt(firstVector[0]**2 + firstVector[1]**2)
-    # creates a vector with length 1 but with the same angle as firstVector
-    unitVecotr = [x / length for x in firstVector]
-    # creates a vector with the same angle as firstVector and with a given length
-    partialVector = [x * spacing for x in unitVecotr]
-    # calculates how many times has the drone travel a given length in firstVector's direction to reach the end
-    steps = int(length / spacing)
-    # calculates all the cords our drone needs to travel in order to scan the field
-    cords = [[corners[0][0], corners[0][1]], [corners[2][0], corners[2][1]]]
-    # it will fly in the secondVector's direction there and back again, but move in partialVector's direction each step
-    for x in range(int(steps)):
-        cords.append([(cords[2 * (x + 1) -1][0] + partialVector[0]), (cords[2 * (x + 1) -1][1] + partialVector[1])])
-        cords.append([(cords[2 * (x + 1)][0] - secondVector[0] * (-1)**x), (cords[2 * (x + 1)][1] - secondVector[1] * (-1)**x)])
-    # flies the actual drone
-    cords.reverse() # optional step
-    for x in range(len(cords)):
-        print("Drone flies to cords x = " + str(float(cords[x][0])) + " and y = " + str(float(cords[x][1])))
-        client.moveToPositionAsync(float(cords[x][0]), float(cords[x][1]), height, velocity).join()
-    # returns back
-    print("Drone returns back")
-    client.moveToPositionAsync(0, 0, height, velocity).join() 
+# flies a lawnmower pattern over the area, corners can be any convex polygon given in any order and spacing
+# is the distance between two sweeps, None derives it from the camera footprint and SURVEY_OVERLAP
+def flyOverRectangleArea(client, corners, spacing, height, velocity, vehicle='', keepFlying=lambda: True):
+    if spacing is None:
+        spacing = sweepSpacing(height, CAMERA_FOV, SURVEY_OVERLAP)
+    waypoints = lawnmowerWaypoints(corners, spacing)
+    # starts from the end of the path closer to the drone
+    if np.hypot(*waypoints[-1]) < np.hypot(*waypoints[0]):
+        waypoints = waypoints[::-1]
+    # returns back at the end of the same path
+    waypoints = np.vstack([waypoints, [0, 0]])
+    flyWaypoints(client, waypoints, height, velocity, PATH_CHUNK_SIZE, vehicle, keepFlying)
     
 
-def resetAirSimClient(client):
-    client.hoverAsync().join()
-    client.armDisarm(False)
-    client.reset()
-    client.enableApiControl(False)
+def resetAirSimClient(client, vehicle=''):
+    client.hoverAsync(vehicle_name=vehicle).join()
+    client.armDisarm(False, vehicle)
+    # reset moves every vehicle back to its start, so it is left out while other drones may still fly
+    if not vehicle:
+        client.reset()
+    client.enableApiControl(False, vehicle)
     
-def initializeAirSimClient(client):
+def initializeAirSimClient(client, vehicle=''):
     client.confirmConnection()
-    client.enableApiControl(True)
-    client.armDisarm(True)
+    client.enableApiControl(True, vehicle)
+    client.armDisarm(True, vehicle)
     client.simEnableWeather(True)
 
 def getAirSimClient():
-    tempClient = None
-    try:
-        tempClient = airsim.MultirotorClient()
-    except:
-        print("Airsim is not ready yet")
-        while tempClient is None:
-            try:
-                tempClient = airsim.MultirotorClient()
-            except:
-                pass
+    return waitFor(connectAirSim, "AirSim", CONNECT_TIMEOUT)
+
+# creates an AirSim client which answered a ping
+def connectAirSim():
+    tempClient = airsim.MultirotorClient()
+    tempClient.ping()
     return tempClient
 
-# tells drone Where to fly
-def flyDrone():
+# blocks until captureImages took the api control of the drone, either on the shared event or by polling with backoff
+def waitForApiControl(client, ready=None, vehicle=''):
+    if ready is not None:
+        ready.wait()
+    else:
+        waitFor(lambda: client.isApiControlEnabled(vehicle), "AirSim api control")
+
+# tells drone Where to fly, corners are given in the coordinates of the drone and spacing None derives it from the camera,
+# once keepFlying() is false no further part of the path is started and the drone hovers where it is
+def flyDrone(ready=None, vehicle='', corners=SURVEY_AREA, spacing=17, keepFlying=lambda: True):
     flyClient = getAirSimClient()
-    while not flyClient.isApiControlEnabled():
-        pass
+    waitForApiControl(flyClient, ready, vehicle)
 
-    flyClient.takeoffAsync().join()
-    flyOverRectangleArea(flyClient, np.array([[0, 0], [-100, 0], [0, -80], [-100, -80]]), 17, -1, 10)
-    resetAirSimClient(flyClient)
+    if keepFlying():
+        flyClient.takeoffAsync(vehicle_name=vehicle).join()
+        flyOverRectangleArea(flyClient, corners, spacing, -1, 10, vehicle, keepFlying)
+    resetAirSimClient(flyClient, vehicle)
 
-# Collects data from drone
-def captureData():
-    client_mqtt = connect_mqtt()
-    dataClient = getAirSimClient()
+# cancels the path the drone is flying from another client, the client flying it is blocked waiting for the path
+def stopDrone(vehicle=''):
+    getAirSimClient().cancelLastTask(vehicle_name=vehicle)
 
-    while not dataClient.isApiControlEnabled():
-        pass
+# exports the timings of the capture and of the gear and the time the connections took to get ready to influx
+# until the process is stopped
+def exportMetrics():
+    exporter = MetricsExporter(connect_redis(), connect_mqtt(), METRICS_INTERVAL, readyTimes=readyTimes)
+    exporter.run()
 
+# reads one telemetry sample of the drone
+def readSensors(dataClient, vehicle=''):
     sensor_data = {}
-    while dataClient.isApiControlEnabled():
-        state = dataClient.getMultirotorState()
-        sensor_data['speed_x'] = state.kinematics_estimated.linear_velocity.x_val
-        sensor_data['speed_y'] = state.kinematics_estimated.linear_velocity.y_val
-        sensor_data['speed_z'] = state.kinematics_estimated.linear_velocity.z_val
-        sensor_data['speed'] = math.sqrt(sensor_data['speed_x']**2+sensor_data['speed_y']**2+sensor_data['speed_z']**2)
-
-        sensor_data['acceleration_x'] = state.kinematics_estimated.linear_acceleration.x_val
-        sensor_data['acceleration_y'] = state.kinematics_estimated.linear_acceleration.y_val
-        sensor_data['acceleration_z'] = state.kinematics_estimated.linear_acceleration.z_val
-        sensor_data['acceleration'] = math.sqrt(sensor_data['acceleration_x']**2+sensor_data['acceleration_y']**2+sensor_data['acceleration_z']**2)
-
-        sensor_data['altitude'] = state.gps_location.altitude
-        sensor_data['longtitude'] = state.gps_location.longitude
-        sensor_data['latitude'] = state.gps_location.latitude
-
-        sensor_data['orientation_quaternion_w'] = state.kinematics_estimated.orientation.w_val
-        sensor_data['orientation_quaternion_x'] = state.kinematics_estimated.orientation.x_val
-        sensor_data['orientation_quaternion_y'] = state.kinematics_estimated.orientation.y_val
-        sensor_data['orientation_quaternion_z'] = state.kinematics_estimated.orientation.z_val
-
-        sensor_data['x_coordinate'] = state.kinematics_estimated.position.x_val
-        sensor_data['y_coordinate'] = state.kinematics_estimated.position.y_val
-        sensor_data['z_coordinate'] = -state.kinematics_estimated.position.z_val
-
-        #angular_velocity
-        #angular_acceleration
-
-        enviroment = dataClient.simGetGroundTruthEnvironment()
-        sensor_data['air_pressure'] = enviroment.air_pressure
-        sensor_data['temperature'] = enviroment.temperature
-        sensor_data['air_density'] = enviroment.air_density
-
-        sensor_data['gravitational_force_x'] = enviroment.gravity.x_val
-        sensor_data['gravitational_force_y'] = enviroment.gravity.y_val
-        sensor_data['gravitational_force_z'] = enviroment.gravity.z_val
-        sensor_data['gravitational_force'] = math.sqrt(sensor_data['gravitational_force_x']**2+sensor_data['gravitational_force_y']**2+sensor_data['gravitational_force_z']**2)
-
-        magnetometer = dataClient.getMagnetometerData()
-        sensor_data['magnetic_field_strength_x'] = magnetometer.magnetic_field_body.x_val
-        sensor_data['magnetic_field_strength_y'] = magnetometer.magnetic_field_body.y_val
-        sensor_data['magnetic_field_strength_z'] = magnetometer.magnetic_field_body.z_val
-        sensor_data['magnetic_field_strength'] = math.sqrt(sensor_data['magnetic_field_strength_x']**2+sensor_data['magnetic_field_strength_y']**2+sensor_data['magnetic_field_strength_z']**2)
-
-        send(sensor_data, client_mqtt)
-        time.sleep(0.1) # Interval
-
-def captureImages():
-    # connedcts to redis and Airsim
-    conn = connect_redis()
+    state = dataClient.getMultirotorState(vehicle_name=vehicle)
+    sensor_data['speed_x'] = state.kinematics_estimated.linear_velocity.x_val
+    sensor_data['speed_y'] = state.kinematics_estimated.linear_velocity.y_val
+    sensor_data['speed_z'] = state.kinematics_estimated.linear_velocity.z_val
+    sensor_data['speed'] = math.sqrt(sensor_data['speed_x']**2+sensor_data['speed_y']**2+sensor_data['speed_z']**2)
+
+    sensor_data['acceleration_x'] = state.kinematics_estimated.linear_acceleration.x_val
+    sensor_data['acceleration_y'] = state.kinematics_estimated.linear_acceleration.y_val
+    sensor_data['acceleration_z'] = state.kinematics_estimated.linear_acceleration.z_val
+    sensor_data['acceleration'] = math.sqrt(sensor_data['acceleration_x']**2+sensor_data['acceleration_y']**2+sensor_data['acceleration_z']**2)
+
+    sensor_data['altitude'] = state.gps_location.altitude
+    sensor_data['longtitude'] = state.gps_location.longitude
+    sensor_data['latitude'] = state.gps_location.latitude
+
+    sensor_data['orientation_quaternion_w'] = state.kinematics_estimated.orientation.w_val
+    sensor_data['orientation_quaternion_x'] = state.kinematics_estimated.orientation.x_val
+    sensor_data['orientation_quaternion_y'] = state.kinematics_estimated.orientation.y_val
+    sensor_data['orientation_quaternion_z'] = state.kinematics_estimated.orientation.z_val
+
+    sensor_data['x_coordinate'] = state.kinematics_estimated.position.x_val
+    sensor_data['y_coordinate'] = state.kinematics_estimated.position.y_val
+    sensor_data['z_coordinate'] = -state.kinematics_estimated.position.z_val
+
+    #angular_velocity
+    #angular_acceleration
+
+    enviroment = dataClient.simGetGroundTruthEnvironment(vehicle_name=vehicle)
+    sensor_data['air_pressure'] = enviroment.air_pressure
+    sensor_data['temperature'] = enviroment.temperature
+    sensor_data['air_density'] = enviroment.air_density
+
+    sensor_data['gravitational_force_x'] = enviroment.gravity.x_val
+    sensor_data['gravitational_force_y'] = enviroment.gravity.y_val
+    sensor_data['gravitational_force_z'] = enviroment.gravity.z_val
+    sensor_data['gravitational_force'] = math.sqrt(sensor_data['gravitational_force_x']**2+sensor_data['gravitational_force_y']**2+sensor_data['gravitational_force_z']**2)
+
+    magnetometer = dataClient.getMagnetometerData(vehicle_name=vehicle)
+    sensor_data['magnetic_field_strength_x'] = magnetometer.magnetic_field_body.x_val
+    sensor_data['magnetic_field_strength_y'] = magnetometer.magnetic_field_body.y_val
+    sensor_data['magnetic_field_strength_z'] = magnetometer.magnetic_field_body.z_val
+    sensor_data['magnetic_field_strength'] = math.sqrt(sensor_data['magnetic_field_strength_x']**2+sensor_data['magnetic_field_strength_y']**2+sensor_data['magnetic_field_strength_z']**2)
+    return sensor_data
+
+# Collects data from drone every TELEMETRY_INTERVAL while keepRunning() is true, by default as long as the drone is under
+# api control, the samples go to influx through client_mqtt, connected here unless given, to the telemetry ring the frames
+# are joined with when there is one and to the archive of the inspection when its id is given
+def captureData(ready=None, vehicle='', inspectionId=None, telemetry=None, keepRunning=None, client_mqtt=None):
+    client_mqtt = client_mqtt or connect_mqtt()
+    tags = {"clientId": "drone", "vehicle": vehicle} if vehicle else {"clientId": "drone"}
+    writer = TelemetryWriter(client_mqtt, TELEMETRY_FIELDS, tags=tags, maxLines=TELEMETRY_BATCH_SIZE, maxDelay=TELEMETRY_FLUSH_INTERVAL)
+    archive = FlightArchive(ARCHIVE_DIR, inspectionId) if ARCHIVE_DIR and inspectionId else None
+    dataClient = getAirSimClient()
 
-    # creating the consumer group if it does not exist to read the data from the stream
-    res = None
-    try:
-        res = conn.execute_command('xgroup','CREATE','inspection','InspectionGroup','$','MKSTREAM')   
-    except:
-        print("Failed to create consumer group") 
-        """
-        while res is None: # It would by better to check if it, perhaps, doesnt exist already
-            try:
-                res = conn.execute_command('xgroup','CREATE','inspection','InspectionGroup','$','MKSTREAM')    
-            except:
-                pass
-                """
+    waitForApiControl(dataClient, ready, vehicle)
+    keepRunning = keepRunning or (lambda: dataClient.isApiControlEnabled(vehicle))
 
-    # waing to receive Input the redis stream and once the signal is received drone starts flying and stores real time images to Influx in form of bytes.
-    res = None
+    nextSample = time.monotonic()
     try:
-        res = conn.execute_command('xreadgroup','GROUP', 'InspectionGroup','InspectionConsumer','Block', 10000,'STREAMS', 'inspection','>')
-    except:
-        print("No Input from stream yet")
-        while res is None:
-            try:
-                res = conn.execute_command('xreadgroup','GROUP', 'InspectionGroup','InspectionConsumer','Block', 10000,'STREAMS', 'inspection','>')
-            except:
-                pass
+        while keepRunning():
+            sensor_data = readSensors(dataClient, vehicle)
+            writer.write(sensor_data)
+            if telemetry is not None:
+                telemetry.write(time.monotonic(), sensor_data)
+            if archive is not None:
+                archive.append('telemetry', dict(sensor_data, time=time.time_ns(), vehicle=vehicle))
+            # the interval is kept from sample to sample, so the time a sample takes does not add up
+            nextSample = max(nextSample + TELEMETRY_INTERVAL, time.monotonic())
+            time.sleep(max(0, nextSample - time.monotonic()))
+    finally:
+        writer.flush()
+        if archive is not None:
+            archive.flush()
+
+# stream id and inspection id of the signal read from the inspection stream
+def parseInspection(res):
     print(res)
     print("Signal received from stream")
 
     # Prints important IDs
-    count = 1
-    MAX_IMAGES = 50
     currentStreamMapList = list(convertToMap(res[0][1][0]))
     streamID = currentStreamMapList[0]
     inspectionId = currentStreamMapList[1]['inspectionId']
     print("Inspection ID is " + inspectionId )
     print("Stream ID is " + streamID )
-    
-    imageClient = getAirSimClient()
-    initializeAirSimClient(imageClient)
-    setCameraPose(imageClient)
+    return streamID, inspectionId
+
+# waits for the signal to start an inspection on the inspection stream and returns the id of the inspection,
+# conn is a redis.asyncio client so the service keeps running its other coroutines meanwhile
+async def readInspection(conn):
+    # creating the consumer group if it does not exist to read the data from the stream
+    res = None
+    try:
+        res = await conn.execute_command('xgroup','CREATE','inspection','InspectionGroup','$','MKSTREAM')
+    except:
+        print("Failed to create consumer group") 
+
+    # waing to receive Input the redis stream and once the signal is received drone starts flying and stores real time images to Influx in form of bytes.
+    res = await waitForAsync(lambda: conn.execute_command('xreadgroup','GROUP', 'InspectionGroup','InspectionConsumer','Block', 10000,'STREAMS', 'inspection','>'), "Input from stream")
+    streamID, inspectionId = parseInspection(res)
 
     # works every time
     try: 
-        res = conn.execute_command('xack','inspection','InspectionGroup',streamID)
+        res = await conn.execute_command('xack','inspection','InspectionGroup',streamID)
     except:
         print("What the fuck")
     print("Stream Acknowledged " + str(res))
-
-    while imageClient.isApiControlEnabled():
-        imagename = inspectionId + "_" + str(count) + '.jpg'
-        img_rgb = getRealTimeImage(imageClient)
-        addToStream(conn,img_rgb,imagename,MAX_IMAGES)
-        time.sleep(2)
-        print(count)
-        count += 1
-
-    # good ending
+    return inspectionId
+
+# readInspection for the processes without an event loop, on a connection of its own
+def waitForInspection():
+    async def read():
+        conn = await waitForAsync(pingRedisAsync, "Redis at localhost:6379", CONNECT_TIMEOUT)
+        try:
+            return await readInspection(conn)
+        finally:
+            await conn.aclose()
+    return asyncio.run(read())
+
+# fields of the row marking the end of the inspection, seq puts it behind the last frame for ordered consumers
+def finalRowFields(inspectionId, seq=None, vehicle=''):
     lastRow = []
     lastRow.append(['weather','Sunny'])
     lastRow.append(['windSpeed', 5])
     lastRow.append(['isDone','1'])
     lastRow.append(['imagename',''])
     lastRow.append(['image',''])
+    lastRow.append(['inspectionId',inspectionId])
+    if seq is not None:
+        lastRow.append(['seq',seq])
+    if vehicle:
+        lastRow.append(['vehicle',vehicle])
+    return sum(lastRow,[])
+
+# marks the end of the inspection in the inspectiondata stream
+def addFinalRow(conn, inspectionId, seq=None, vehicle=''):
     print("Saving Final Row")
-    conn.execute_command('xadd', 'inspectiondata',  'MAXLEN', '~', str(MAX_IMAGES), '*', *sum(lastRow,[]))
+    conn.execute_command('xadd', 'inspectiondata', '*', *finalRowFields(inspectionId, seq, vehicle))
+
+# captures the images of one drone, waits for the inspection signal itself unless the inspection id is given,
+# every frame gets the telemetry of the moment it was taken from the ring captureData writes to, when there is one,
+# the capture runs while keepRunning() is true, by default as long as the drone is under api control
+def captureImages(ready=None, vehicle='', inspectionId=None, finalRow=True, telemetry=None, keepRunning=None):
+    # connedcts to redis and Airsim
+    conn = connect_redis()
+    if inspectionId is None:
+        inspectionId = waitForInspection()
+    
+    imageClient = getAirSimClient()
+    initializeAirSimClient(imageClient, vehicle)
+    setCameraPose(imageClient, vehicle)
+    if ready is not None:
+        ready.set()
+
+    # captures, encodes and publishes the frames in separate stages until the flight is over
+    spill = SegmentLog(os.path.join(SPILL_DIR, vehicle or 'default'), SPILL_SEGMENT_BYTES) if SPILL_DIR else None
+    engine = CaptureEngine(conn, lambda: captureFrame(imageClient, FRAME_ENCODING == 'png', vehicle),
+                           lambda captured: encodeFrame(captured[0]) + poseFields(captured[1]), inspectionId, STREAM_MEMORY_BUDGET,
+                           fps=CAPTURE_FPS, overlap=CAPTURE_OVERLAP, motion=lambda captured: getMotion(captured[1]), fov=CAMERA_FOV,
+                           queueSize=CAPTURE_QUEUE_SIZE, dropPolicy=CAPTURE_DROP_POLICY, vehicle=vehicle, spill=spill,
+                           join=(lambda clock: frameTelemetry(telemetry, clock)) if telemetry is not None else None)
+    engine.run(keepRunning or (lambda: imageClient.isApiControlEnabled(vehicle)))
+
+    # good ending, the final row follows the last published frame so ordered consumers emit it last
+    if finalRow:
+        addFinalRow(conn, inspectionId, engine.published + 1, vehicle)
+    return engine.published
 
 if __name__ == '__main__':
 
-    #flying_process = (Process(target=flyDrone).start())
-    #sensors_process = (Process(target=captureData).start())
-    camera_process = (Process(target=captureImages).start())
\ No newline at end of file
+    # the flight, the telemetry and the capture run in one asyncio process, see service.py
+    import service
+    service.main()
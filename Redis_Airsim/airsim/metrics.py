@@ -0,0 +1,90 @@
+import time
+import numpy as np
+from telemetry import TelemetryWriter
+
+# upper bounds in ms of the histogram buckets, the last bucket takes everything above
+BUCKETS = np.geomspace(0.05, 100000, 40)
+# fields of the timings stream which count things instead of timing a stage, frames is the number of frames an entry sums up
+COUNTERS = ['cached', 'dropped']
+# fields published for every stage
+HISTOGRAM_FIELDS = ['count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms']
+
+# latency histogram of one stage with fixed buckets, observing is O(log buckets) and needs no memory per sample
+class Histogram:
+    def __init__(self):
+        self.counts = np.zeros(len(BUCKETS) + 1, dtype=np.int64)
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms, n=1):
+        self.counts[np.searchsorted(BUCKETS, ms)] += n
+        self.total += ms * n
+        self.max = max(self.max, ms)
+
+    # upper bound of the bucket holding the quantile, never above the largest sample
+    def quantile(self, q):
+        bucket = np.searchsorted(np.cumsum(self.counts), q * self.counts.sum())
+        return min(float(BUCKETS[bucket]), self.max) if bucket < len(BUCKETS) else self.max
+
+    def fields(self):
+        count = int(self.counts.sum())
+        return {'count': count, 'mean_ms': self.total / count, 'p50_ms': self.quantile(0.5),
+                'p90_ms': self.quantile(0.9), 'p99_ms': self.quantile(0.99), 'max_ms': self.max}
+
+# turns the timings stream written by the drones and the gear into latency histograms and counters,
+# which are published to InfluxDB through MQTT every interval seconds together with the seconds the connections
+# of readyTimes, a dict by name like connections.readyTimes, took to get ready
+class MetricsExporter:
+    def __init__(self, conn, client, interval=10.0, tags={"clientId": "drone"}, topic="iot_center", readyTimes={}):
+        self.conn = conn
+        self.client = client
+        self.interval = interval
+        self.tags = tags
+        self.topic = topic
+        self.readyTimes = readyTimes
+        # ready times already published, a connection waited for again is published again
+        self.publishedReady = {}
+        # only timings written from now on are aggregated
+        self.lastId = '$'
+        self.histograms = {}
+        self.counters = dict.fromkeys(COUNTERS, 0.0)
+        self.stageWriters = {}
+        self.counterWriter = TelemetryWriter(client, COUNTERS, measurement="pipeline_counters", tags=tags, topic=topic, maxLines=1)
+
+    # every entry holds the sums of its stages over its frames, observed as the time per frame
+    def observe(self, fields):
+        fields = {k.decode(): float(v) for k, v in fields.items()}
+        frames = max(int(fields.get('frames', 1)), 1)
+        for name, value in fields.items():
+            if name in COUNTERS:
+                self.counters[name] += value
+            elif name != 'frames':
+                self.histograms.setdefault(name, Histogram()).observe(value / frames, frames)
+
+    # publishes the histograms of the last interval and the counters since the start, one line per stage
+    def publish(self):
+        for stage, histogram in self.histograms.items():
+            if stage not in self.stageWriters:
+                self.stageWriters[stage] = TelemetryWriter(self.client, HISTOGRAM_FIELDS, measurement="pipeline_latency",
+                                                           tags=dict(self.tags, stage=stage), topic=self.topic, maxLines=1)
+            self.stageWriters[stage].write(histogram.fields())
+        self.counterWriter.write(self.counters)
+        self.histograms = {}
+        for name, seconds in list(self.readyTimes.items()):
+            if self.publishedReady.get(name) != seconds:
+                writer = TelemetryWriter(self.client, ['ready_s'], measurement="readiness", tags=dict(self.tags, dependency=name), topic=self.topic, maxLines=1)
+                writer.write({'ready_s': seconds})
+                self.publishedReady[name] = seconds
+
+    def run(self, keepRunning=lambda: True):
+        nextPublish = time.monotonic() + self.interval
+        while keepRunning():
+            block = max(1, int((nextPublish - time.monotonic()) * 1000))
+            res = self.conn.execute_command('xread', 'COUNT', 1000, 'BLOCK', block, 'STREAMS', 'timings', self.lastId)
+            if res:
+                for entryId, fields in res[0][1]:
+                    self.observe(fields)
+                    self.lastId = entryId
+            if time.monotonic() >= nextPublish:
+                self.publish()
+                nextPublish += self.interval
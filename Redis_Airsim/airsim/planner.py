@@ -0,0 +1,99 @@
+import math
+import numpy as np
+import airsim
+
+# width in metres of the ground seen by the camera pointing straight down from the given altitude
+def footprintWidth(altitude, fov=90):
+    return 2 * abs(altitude) * math.tan(math.radians(fov) / 2)
+
+# distance between two sweeps so that neighbouring images overlap by the given fraction
+def sweepSpacing(altitude, fov=90, overlap=0.0):
+    return footprintWidth(altitude, fov) * (1 - overlap)
+
+# orders the corners of a convex polygon around its centre, so they can be given in any order
+def orderCorners(corners):
+    corners = np.asarray(corners, dtype=np.float64)
+    centre = corners.mean(axis=0)
+    angles = np.arctan2(corners[:, 1] - centre[1], corners[:, 0] - centre[0])
+    return corners[np.argsort(angles)]
+
+# angle of the longest edge of the polygon, sweeping along it keeps the number of turns low
+def longestEdgeAngle(polygon):
+    edges = np.roll(polygon, -1, axis=0) - polygon
+    longest = edges[np.argmax(np.hypot(edges[:, 0], edges[:, 1]))]
+    return math.atan2(longest[1], longest[0])
+
+# rotates the points around the origin by the angle
+def rotate(points, angle):
+    c, s = math.cos(angle), math.sin(angle)
+    return points @ np.array([[c, s], [-s, c]])
+
+# computes the lawnmower waypoints (x, y) covering a convex polygon, sweeps are spacing metres apart
+# and run along the longest edge unless an angle in radians is given
+def lawnmowerWaypoints(corners, spacing, angle=None):
+    polygon = orderCorners(corners)
+    if angle is None:
+        angle = longestEdgeAngle(polygon)
+    # in the rotated frame every sweep is a horizontal line
+    rotated = rotate(polygon, -angle)
+    start = rotated
+    end = np.roll(rotated, -1, axis=0)
+
+    ymin, ymax = rotated[:, 1].min(), rotated[:, 1].max()
+    lines = ymin + np.arange(int((ymax - ymin) / spacing + 1e-9) + 1) * spacing
+
+    # crossing of every sweep line with every edge, edges which the line misses give nan
+    dy = end[:, 1] - start[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (lines[:, None] - start[None, :, 1]) / dy[None, :]
+        xs = start[None, :, 0] + t * (end[:, 0] - start[:, 0])[None, :]
+    xs = np.where((t >= 0) & (t <= 1), xs, np.nan)
+    # edges lying on a sweep line cross it at both of their ends
+    onLine = np.isclose(lines[:, None], start[None, :, 1])
+    xs = np.concatenate([xs, np.where(onLine, start[None, :, 0], np.nan)], axis=1)
+
+    hit = ~np.all(np.isnan(xs), axis=1)
+    lines, xs = lines[hit], xs[hit]
+    left, right = np.nanmin(xs, axis=1), np.nanmax(xs, axis=1)
+
+    # every other sweep runs backwards
+    backwards = np.arange(len(lines)) % 2 == 1
+    first = np.where(backwards, right, left)
+    second = np.where(backwards, left, right)
+    waypoints = np.empty((2 * len(lines), 2))
+    waypoints[0::2] = np.column_stack([first, lines])
+    waypoints[1::2] = np.column_stack([second, lines])
+    return rotate(waypoints, angle)
+
+# clips a convex polygon to the part where y lies between low and high
+def clipStrip(polygon, low, high):
+    for value, above in ((low, True), (high, False)):
+        clipped = []
+        for p, q in zip(polygon, np.roll(polygon, -1, axis=0)):
+            pInside = p[1] >= value if above else p[1] <= value
+            qInside = q[1] >= value if above else q[1] <= value
+            if pInside:
+                clipped.append(p)
+            if pInside != qInside:
+                clipped.append(p + (value - p[1]) / (q[1] - p[1]) * (q - p))
+        polygon = np.array(clipped)
+    return polygon
+
+# splits a convex area into parts strips of equal width, every strip holds whole sweeps along the longest edge of the area
+def splitArea(corners, parts):
+    polygon = orderCorners(corners)
+    angle = longestEdgeAngle(polygon)
+    rotated = rotate(polygon, -angle)
+    bounds = np.linspace(rotated[:, 1].min(), rotated[:, 1].max(), parts + 1)
+    return [rotate(clipStrip(rotated, low, high), angle) for low, high in zip(bounds[:-1], bounds[1:])]
+
+# flies the waypoints with as few calls to AirSim as possible, one moveOnPathAsync per chunk of chunkSize waypoints
+def flyWaypoints(client, waypoints, height, velocity, chunkSize=None, vehicle='', keepFlying=lambda: True):
+    path = [airsim.Vector3r(float(x), float(y), height) for x, y in waypoints]
+    if chunkSize is None:
+        chunkSize = len(path)
+    for start in range(0, len(path), chunkSize):
+        if not keepFlying():
+            return
+        print("Drone flies through " + str(len(path[start:start + chunkSize])) + " waypoints")
+        client.moveOnPathAsync(path[start:start + chunkSize], velocity, vehicle_name=vehicle).join()
@@ -0,0 +1,117 @@
+import signal
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import havran
+from timeline import TelemetryRing
+from planner import splitArea
+from connections import waitForAsync, pingRedisAsync
+
+# AirSim vehicles surveying the area and their start positions (x, y) in metres as set in the AirSim settings.json,
+# '' is the only drone of the default settings.json, two drones are e.g. {'Drone1': (0, 0), 'Drone2': (0, -10)}
+VEHICLES = {'': (0, 0)}
+# distance between two sweeps of a drone, None derives it from the camera footprint
+SURVEY_SPACING = 17
+# blocking AirSim jobs running at once for every vehicle: the flight, the capture, the telemetry and stopping the flight
+THREADS_PER_VEHICLE = 4
+
+# connects to mqtt, the network loop of paho runs in its own thread so publishing never blocks the event loop
+def connectMqtt():
+    client = havran.connect_mqtt()
+    client.loop_start()
+    return client
+
+# surveys the region with one vehicle, the flight, the capture and the telemetry block in the executor,
+# cancelling it stops the drone and the capture still publishes every frame it holds, the number of frames goes to published
+async def surveyVehicle(executor, mqtt, inspectionId, vehicle, region, spacing, published):
+    loop = asyncio.get_running_loop()
+    call = lambda fn, *args: loop.run_in_executor(executor, fn, *args)
+    # ready is set once the capture took the api control, done once the flight is over
+    ready = threading.Event()
+    done = threading.Event()
+    keepRunning = lambda: not done.is_set()
+    ring = TelemetryRing(havran.TELEMETRY_FIELDS)
+
+    capture = asyncio.wrap_future(executor.submit(havran.captureImages, ready, vehicle, inspectionId, False, ring, keepRunning))
+    telemetry = asyncio.wrap_future(executor.submit(havran.captureData, ready, vehicle, inspectionId, ring, keepRunning, mqtt))
+    # the flight keeps running in its thread when awaiting it is cancelled, it is awaited again through a new wrapper
+    flightJob = executor.submit(havran.flyDrone, ready, vehicle, region, spacing, keepRunning)
+    flight = asyncio.wrap_future(flightJob)
+    try:
+        # the capture runs until the flight is over, when it ends first it failed, maybe before it took the api control
+        # which the flight and the telemetry wait for, so they are released and the flight is not started
+        await asyncio.wait([flight, capture], return_when=asyncio.FIRST_COMPLETED)
+        if capture.done():
+            done.set()
+            ready.set()
+        await flight
+    except asyncio.CancelledError:
+        print("Stopping " + (vehicle or "the drone"))
+        done.set()
+        ready.set()
+        # the thread flying the drone waits for its path, cancelling the path lets it hover and release the drone
+        await call(havran.stopDrone, vehicle)
+        await asyncio.wrap_future(flightJob)
+        raise
+    finally:
+        done.set()
+        ready.set()
+        try:
+            await telemetry
+            published[vehicle] = await capture
+        finally:
+            ring.close()
+
+# surveys the area with all vehicles in one process until every flight is over or the service is cancelled,
+# then marks the end of the inspection with its final row
+async def serve(corners=havran.SURVEY_AREA, vehicles=VEHICLES, spacing=SURVEY_SPACING):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, asyncio.current_task().cancel)
+        except NotImplementedError:
+            # Windows has no signal handlers in asyncio, Ctrl+C still cancels the service through asyncio.run
+            pass
+
+    conn = await waitForAsync(pingRedisAsync, "Redis at localhost:6379", havran.CONNECT_TIMEOUT)
+    executor = ThreadPoolExecutor(max_workers=THREADS_PER_VEHICLE * len(vehicles) + 1)
+    mqtt = await loop.run_in_executor(executor, connectMqtt)
+    # the exporter only waits on redis, a daemon thread ends with the service
+    threading.Thread(target=havran.exportMetrics, daemon=True).start()
+
+    try:
+        inspectionId = await havran.readInspection(conn)
+        published = {}
+        tasks = []
+        for (vehicle, start), region in zip(vehicles.items(), splitArea(corners, len(vehicles))):
+            # the flight of every vehicle is planned in its own coordinates, which start where the vehicle starts
+            tasks.append(asyncio.create_task(surveyVehicle(executor, mqtt, inspectionId, vehicle, region - start, spacing, published)))
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            print("Survey cancelled")
+        finally:
+            # a vehicle which failed stops the others
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # a single drone puts the final row behind its last frame for ordered consumers
+            vehicle = next(iter(vehicles))
+            seq = published[vehicle] + 1 if len(vehicles) == 1 and vehicle in published else None
+            print("Saving Final Row")
+            await conn.execute_command('xadd', 'inspectiondata', '*', *havran.finalRowFields(inspectionId, seq, vehicle if len(vehicles) == 1 else ''))
+    finally:
+        mqtt.loop_stop()
+        mqtt.disconnect()
+        await conn.aclose()
+        executor.shutdown()
+
+def main():
+    try:
+        asyncio.run(serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import os
+import time
+import pickle
+import struct
+
+# length prefix of every record in a segment
+HEADER = struct.Struct('<I')
+
+# append only log of stream entries on disk, split into segment files which are deleted once all their entries are replayed,
+# segments left behind by a crashed run are found again and replayed first
+class SegmentLog:
+    def __init__(self, directory, segmentBytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+        os.makedirs(directory, exist_ok=True)
+        # segments are named by the time they were started, so sorting them sorts their entries
+        self.segments = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.seg'))
+        self.records = sum(self.countRecords(path) for path in self.segments)
+        self.writer = None
+        self.reader = None
+        # entries popped since the last commit can be rewound, the segments read through are deleted only by the commit
+        self.readSegments = []
+        # offset of the reader in the first segment at the last commit and number of entries popped since then
+        self.committedOffset = 0
+        self.uncommitted = 0
+
+    def countRecords(self, path):
+        count = 0
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return count
+                f.seek(HEADER.unpack(header)[0], os.SEEK_CUR)
+                count += 1
+
+    def pending(self):
+        return self.records > 0
+
+    # appends the fields of one entry, starting a new segment once the current one is full
+    def append(self, fields):
+        if self.writer is None or self.writer.tell() >= self.segmentBytes:
+            if self.writer is not None:
+                self.writer.close()
+            path = os.path.join(self.directory, str(time.time_ns()) + '.seg')
+            self.segments.append(path)
+            self.writer = open(path, 'ab')
+        data = pickle.dumps(fields, pickle.HIGHEST_PROTOCOL)
+        self.writer.write(HEADER.pack(len(data)) + data)
+        self.records += 1
+
+    # makes the appended entries readable, called once after a batch of appends
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    # removes and returns the oldest entry, None when there is none, the entry is gone for good only after commit()
+    def pop(self):
+        self.flush()
+        while self.segments:
+            if self.reader is None:
+                self.reader = open(self.segments[0], 'rb')
+            header = self.reader.read(HEADER.size)
+            if len(header) == HEADER.size:
+                size = HEADER.unpack(header)[0]
+                data = self.reader.read(size)
+                self.records -= 1
+                self.uncommitted += 1
+                # a crash while writing leaves the last entry of its segment cut short, it is skipped
+                if len(data) == size:
+                    return pickle.loads(data)
+                continue
+            # the segment still being written has nothing more for now, a finished one is done with
+            if self.writer is not None and self.writer.name == self.segments[0]:
+                return None
+            self.reader.close()
+            self.reader = None
+            self.readSegments.append(self.segments.pop(0))
+        return None
+
+    # the entries popped so far were delivered, their finished segments are deleted
+    def commit(self):
+        for path in self.readSegments:
+            os.remove(path)
+        self.readSegments = []
+        self.committedOffset = self.reader.tell() if self.reader is not None else 0
+        self.uncommitted = 0
+
+    # puts the entries popped since the last commit back, they are popped again in the same order
+    def rewind(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        self.segments = self.readSegments + self.segments
+        self.readSegments = []
+        self.records += self.uncommitted
+        self.uncommitted = 0
+        if self.committedOffset:
+            self.reader = open(self.segments[0], 'rb')
+            self.reader.seek(self.committedOffset)
+
+    # closes the segments, deleting them when every entry was replayed and committed
+    def close(self):
+        self.rewind()
+        for f in (self.writer, self.reader):
+            if f is not None:
+                f.close()
+        self.writer = None
+        self.reader = None
+        if not self.pending():
+            for path in self.segments:
+                os.remove(path)
+            self.segments = []
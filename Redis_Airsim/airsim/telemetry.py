@@ -0,0 +1,40 @@
+import math
+import time
+
+# escapes measurement names, tag keys, tag values and field keys for the influx line protocol
+def escape(text, measurement=False):
+    text = str(text).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+    return text if measurement else text.replace('=', '\\=')
+
+# writes telemetry samples as influx line protocol, batching many samples into one MQTT message
+class TelemetryWriter:
+    def __init__(self, client, fields, measurement="environment", tags={"clientId": "drone"}, topic="iot_center", maxLines=50, maxDelay=1.0):
+        self.client = client
+        self.topic = topic
+        self.maxLines = maxLines
+        self.maxDelay = maxDelay
+        # the measurement, tags and field names never change, so they are escaped only once
+        self.prefix = escape(measurement, True) + ''.join(',' + escape(k) + '=' + escape(v) for k, v in sorted(tags.items())) + ' '
+        self.fields = [(name, escape(name) + '=') for name in fields]
+        self.lines = []
+        self.firstWrite = None
+
+    # adds one sample, the values are looked up by the field names given to the writer
+    def write(self, values, timestamp=None):
+        fields = ','.join(key + repr(float(values[name])) for name, key in self.fields if math.isfinite(values[name]))
+        if not fields:
+            return
+        if timestamp is None:
+            timestamp = time.time_ns()
+        self.lines.append(self.prefix + fields + ' ' + str(timestamp))
+        if self.firstWrite is None:
+            self.firstWrite = time.monotonic()
+        if len(self.lines) >= self.maxLines or time.monotonic() - self.firstWrite >= self.maxDelay:
+            self.flush()
+
+    # publishes all buffered samples as a single multi-line message
+    def flush(self):
+        if self.lines:
+            self.client.publish(self.topic, '\n'.join(self.lines))
+            self.lines = []
+        self.firstWrite = None
@@ -0,0 +1,69 @@
+import os
+import numpy as np
+from multiprocessing import shared_memory
+
+# telemetry samples kept in the ring, 60 s at the default 0.1 s interval
+RING_SIZE = 600
+
+# the last telemetry samples of a drone in shared memory, written by the telemetry process and read by the capture process,
+# every sample is stamped with time.monotonic(), which is the same clock in every process of the host,
+# the memory is allocated once so it stays the same however long the flight is
+class TelemetryRing:
+    def __init__(self, fields, capacity=RING_SIZE, name=None):
+        # None creates the shared memory, a name attaches to the ring created by another process
+        self.fields = list(fields)
+        self.capacity = capacity
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=8 * (1 + capacity * (1 + len(self.fields))))
+        self.name = self.memory.name
+        # process which created the ring, a forked child inherits the object but must not free the memory
+        self.owner = os.getpid() if name is None else None
+        # number of samples written so far, followed by the rows (time, fields...) of the ring
+        self.written = np.ndarray((1,), dtype=np.int64, buffer=self.memory.buf)
+        self.rows = np.ndarray((capacity, 1 + len(self.fields)), dtype=np.float64, buffer=self.memory.buf, offset=8)
+        if name is None:
+            self.written[0] = 0
+
+    # other processes get the ring attached by its name
+    def __reduce__(self):
+        return (TelemetryRing, (self.fields, self.capacity, self.name))
+
+    # adds a sample, fields missing from it are nan, there is only one writer so the count is updated after the row
+    def write(self, clock, sample):
+        count = int(self.written[0])
+        row = self.rows[count % self.capacity]
+        row[0] = clock
+        row[1:] = [sample.get(field, np.nan) for field in self.fields]
+        self.written[0] = count + 1
+
+    # copy of the samples in the order they were written, rows overwritten while copying are left out
+    def samples(self):
+        before = int(self.written[0])
+        rows = self.rows.copy()
+        after = int(self.written[0])
+        first = max(before - self.capacity, after + 1 - self.capacity, 0)
+        return rows[np.arange(first, before) % self.capacity]
+
+    # telemetry at the given time, interpolated between the samples around it or taken from the nearest one
+    # when the time is outside of them, None when no sample is within maxGap seconds
+    def at(self, clock, maxGap):
+        rows = self.samples()
+        if not len(rows):
+            return None
+        i = int(np.searchsorted(rows[:, 0], clock))
+        if 0 < i < len(rows) and rows[i, 0] - rows[i - 1, 0] <= 2 * maxGap:
+            # linear between samples a tenth of a second apart, close enough for the orientation too
+            weight = (clock - rows[i - 1, 0]) / max(rows[i, 0] - rows[i - 1, 0], 1e-9)
+            values = rows[i - 1, 1:] * (1 - weight) + rows[i, 1:] * weight
+        else:
+            nearest = rows[min(i, len(rows) - 1)] if i == 0 or i == len(rows) or clock - rows[i - 1, 0] > rows[i, 0] - clock else rows[i - 1]
+            if abs(nearest[0] - clock) > maxGap:
+                return None
+            values = nearest[1:]
+        return dict(zip(self.fields, values.tolist()))
+
+    # detaches from the shared memory, the process which created the ring also frees it
+    def close(self):
+        del self.written, self.rows
+        self.memory.close()
+        if self.owner == os.getpid():
+            self.memory.unlink()
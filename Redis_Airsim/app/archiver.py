@@ -0,0 +1,83 @@
+import os
+import time
+from archive import FlightArchive, STRING_FIELDS
+from init import connect_redis
+
+# directory the predictions of every inspection are archived to, the same one the drone archives the telemetry to
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+# seconds between two flushes of everything buffered
+ARCHIVE_FLUSH_INTERVAL = float(os.environ.get('ARCHIVE_FLUSH_INTERVAL', 10.0))
+# predictions read from the stream at once
+READ_COUNT = 1000
+
+# row of the predictions table from an entry of the predictions stream, its time is the time of the entry in ns
+def predictionRow(entryId, fields):
+    row = {'time': int(entryId.split(b'-')[0]) * 1000000, 'entryId': entryId.decode()}
+    for key, value in fields.items():
+        key = key.decode()
+        value = value.decode()
+        if key in STRING_FIELDS:
+            row[key] = value
+        else:
+            try:
+                row[key] = float(value)
+            except ValueError:
+                row[key] = None
+    return row
+
+# chunks of the predictions are named by the id of their first entry, its sequence padded so the names sort like the ids
+def chunkName(rows):
+    millis, seq = rows[0]['entryId'].split('-')
+    return millis + '-' + seq.zfill(10)
+
+# archives the predictions stream by inspection until keepRunning() is false, continuing after the last archived entry,
+# whose id is written right after every flush, the rows a crash before that write archives again after the restart
+# start at the same entry and replace their chunk instead of repeating in a new one
+def archivePredictions(conn, directory=ARCHIVE_DIR, keepRunning=lambda: True):
+    os.makedirs(directory, exist_ok=True)
+    lastIdPath = os.path.join(directory, 'predictions.lastid')
+    lastId = '0'
+    if os.path.exists(lastIdPath):
+        with open(lastIdPath) as f:
+            lastId = f.read().strip()
+    flights = {}
+
+    # writes the rows of every open inspection and then the id of the last entry they hold
+    def flush():
+        for archive in flights.values():
+            archive.flush()
+        with open(lastIdPath + '.tmp', 'w') as f:
+            f.write(lastId)
+        os.replace(lastIdPath + '.tmp', lastIdPath)
+
+    nextFlush = time.monotonic() + ARCHIVE_FLUSH_INTERVAL
+    try:
+        while keepRunning():
+            res = conn.execute_command('xread', 'COUNT', READ_COUNT, 'BLOCK', 1000, 'STREAMS', 'predictions', lastId)
+            for entryId, fields in (res[0][1] if res else []):
+                lastId = entryId.decode()
+                row = predictionRow(entryId, fields)
+                inspectionId = row.get('inspectionId')
+                if not inspectionId:
+                    continue
+                if inspectionId not in flights:
+                    flights[inspectionId] = FlightArchive(directory, inspectionId, chunkName=chunkName)
+                flights[inspectionId].append('predictions', row)
+                # the final row of an inspection closes its archive
+                if row.get('isDone') == 1:
+                    flights.pop(inspectionId).flush()
+                    flush()
+            if time.monotonic() >= nextFlush:
+                flush()
+                nextFlush = time.monotonic() + ARCHIVE_FLUSH_INTERVAL
+    finally:
+        flush()
+
+# keeps archiving the predictions, continuing from the last archived one
+def run():
+    conn = connect_redis()
+    print("Archiving predictions to " + ARCHIVE_DIR)
+    archivePredictions(conn, ARCHIVE_DIR)
+
+if __name__ == '__main__':
+    run()
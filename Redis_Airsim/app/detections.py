@@ -0,0 +1,28 @@
+from gearconsumer import Labels, detectionsKey
+
+# turns the members returned by GEOSEARCH into detections
+def toDetections(label, found):
+    detections = []
+    for member, (longitude, latitude) in found:
+        imagename, index, score = member.decode().rsplit('|', 2)
+        detections.append({'label': label, 'imagename': imagename, 'index': int(index), 'score': float(score),
+                           'longitude': float(longitude), 'latitude': float(latitude)})
+    return detections
+
+# runs the same GEOSEARCH on the index of every label of the inspection in one round trip
+def search(conn, inspectionId, labels, *query):
+    pipe = conn.pipeline(transaction=False)
+    for label in labels:
+        pipe.execute_command('geosearch', detectionsKey(inspectionId, label), *query, 'WITHCOORD')
+    detections = []
+    for label, found in zip(labels, pipe.execute()):
+        detections += toDetections(label, found)
+    return detections
+
+# detections of the inspection found within radius metres of the point
+def queryRadius(conn, inspectionId, longitude, latitude, radius, labels=Labels):
+    return search(conn, inspectionId, labels, 'FROMLONLAT', longitude, latitude, 'BYRADIUS', radius, 'm')
+
+# detections of the inspection found in the box of width x height metres centred on the point
+def queryBox(conn, inspectionId, longitude, latitude, width, height, labels=Labels):
+    return search(conn, inspectionId, labels, 'FROMLONLAT', longitude, latitude, 'BYBOX', width, height, 'm')
@@ -1,59 +1,194 @@
-from PIL import Image,ImageFont,ImageDraw
+from PIL import Image
 import io
+import json
 import cv2
 import numpy as np
-import redisAI
-import redisgears
-from azure.storage.blob import BlobClient
-from azure.storage.blob import ContainerClient
-import pandas as pd
+try:
+    import redisAI
+    import redisgears
+except ImportError:
+    # imported by worker.py, which runs the same logic outside of RedisGears
+    redisAI = None
+    redisgears = None
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import quote
+from collections import OrderedDict
+import threading
+import queue
 import sys
+import os
+import time
 
 
-MAX_IMAGES = 50
+# maximum number of images stacked into one run of the model
+BATCH_SIZE = 8
+# maximum time in ms the stream reader waits for a batch to fill up
+BATCH_DURATION = 500
+# boxes scoring under this probability are thrown away
+SCORE_THRESHOLD = float(os.environ.get('SCORE_THRESHOLD', 0.5))
+# horizontal field of view of the drone camera in degrees
+CAMERA_FOV = float(os.environ.get('CAMERA_FOV', 90))
+# detections are indexed in a Redis geo set per inspection and label, named by this prefix, the inspection and the label
+DETECTIONS_KEY = 'detections:'
+# seconds the detections of an inspection are kept after the last of them was indexed
+DETECTIONS_TTL = int(os.environ.get('DETECTIONS_TTL', 30 * 24 * 3600))
+EARTH_RADIUS = 6378137.0
 # Categories of different sections in the images
 Labels = ["cultivatedLand","damageArea","highQualityCrop","inFertileLand","lowQualityCrop","other"]
+# 'draw' uploads the images with the boxes drawn into them, 'metadata' uploads them as they came
+# and stores the boxes with the upload in the uploads Stream
+RENDER_MODE = os.environ.get('RENDER_MODE', 'draw')
+# width the uploaded images are scaled down to, 0 keeps their size
+RENDER_WIDTH = int(os.environ.get('RENDER_WIDTH', 0))
+# jpeg quality of the uploaded images
+RENDER_QUALITY = int(os.environ.get('RENDER_QUALITY', 75))
 # container name on the Azure blob storag
 ContainerName = 'droneimages'
+# number of images uploaded to Azure at the same time
+UPLOAD_WORKERS = 4
+# maximum number of images waiting for the upload before the gear blocks
+MAX_PENDING_UPLOADS = 32
+# number of recent model results kept to be reused for near duplicate frames, 0 turns the cache off
+CACHE_SIZE = int(os.environ.get('INFERENCE_CACHE_SIZE', 256))
+# frames whose perceptual hashes differ in at most this many of the 64 bits count as duplicates
+CACHE_DISTANCE = int(os.environ.get('INFERENCE_CACHE_DISTANCE', 3))
+# Redis hash counting the hits and misses of the cache
+CACHE_STATS_KEY = 'inferencecache'
+# the timings stream keeps about this many entries
+TIMINGS_LENGTH = 10000
+# the uploads stream keeps about this many entries
+UPLOADS_LENGTH = 100000
+# 'auto' splits big frames taken high enough into tiles, 'on' splits every frame big enough, 'off' never does
+TILE_MODE = os.environ.get('TILE_MODE', 'auto')
+# most tiles along the short side of a frame, a tile is never cut from less than 320 pixels
+TILE_MAX_GRID = int(os.environ.get('TILE_MAX_GRID', 2))
+# fraction of a tile shared with its neighbours, objects cut by one tile are whole in the next one
+TILE_OVERLAP = 0.2
+# altitude in metres above which the objects get too small for the whole frame in 'auto' mode
+TILE_MIN_ALTITUDE = float(os.environ.get('TILE_MIN_ALTITUDE', 30))
+# boxes of the same label overlapping more than this after merging the tiles are one detection
+NMS_IOU = 0.5
+# number of input buffers of different sizes kept by every execution thread
+INPUT_BUFFERS = 4
 
-# add boxes to image to show box corner around the areas categorized by the AI model
-def add_boxes_to_images(img, predictions, classes, blob, detectedProbability):
-    try:
-        for idx,pred in enumerate(predictions):
-            x = int(pred[0] * 600)
-            y = int(pred[1] * 600)
-
-            width = int(pred[2] * 600)
-            height = int(pred[3] * 600)
-            shape = [(x, y), (width, height)]
-
-            font = ImageFont.truetype(r'/data/fonts/ariblk.ttf', 20)
-            text = Labels[classes[idx]] + "( " + str(detectedProbability[idx]*100) + " )"
-            
-            ImageDraw.Draw(img).rectangle(shape, outline ="red") 
-            ImageDraw.Draw(img).text((x, y), text, fill ="red", align ="left",font=font)
-        saveImageToAzure(img,blob)    
-    except:
-        xlog('add_boxes_to_images: error:', sys.exc_info()[0])
+# state of the upload stage shared by all executions of the gear
+containerClient = None
+containerLock = threading.Lock()
+# its threads are started by the first uploads
+uploadPool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+uploadSlots = threading.BoundedSemaphore(MAX_PENDING_UPLOADS)
+uploadResults = queue.Queue()
+pendingUploads = []
+# guards pendingUploads, every execution thread of the gear queues uploads to it
+pendingLock = threading.Lock()
+# input buffers of the model, every execution thread of the gear gets its own
+buffers = threading.local()
+# model results of recent frames by their perceptual hash, the least recently used are evicted first
+inferenceCache = OrderedDict()
+cacheLock = threading.Lock()
+
+# add boxes to image to show box corner around the areas categorized by the AI model, the boxes are relative
+# to the size of the image and all of them are drawn by one call, only the labels need one call each
+def add_boxes_to_images(img, predictions, classes, detectedProbability):
+    if not len(predictions):
+        return
+    height, width = img.shape[:2]
+    corners = np.rint(np.asarray(predictions)[:, :4] * [width, height, width, height]).astype(np.int32)
+    outlines = corners[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
+    cv2.polylines(img, list(outlines), True, (0, 0, 255), max(1, width // 600))
+
+    scale = width / 1200
+    for (x, y), label, probability in zip(corners[:, :2], classes, detectedProbability):
+        text = Labels[label] + " (" + str(round(float(probability) * 100, 1)) + ")"
+        cv2.putText(img, text, (int(x), max(int(y) - 4, 10)), cv2.FONT_HERSHEY_SIMPLEX, scale, (0, 0, 255), max(1, width // 600), cv2.LINE_AA)
+
+# the image of the stream entry as it is uploaded, at RENDER_WIDTH with the boxes drawn unless only their metadata is stored
+def renderImage(value, predictions, classes, detectedProbability):
+    encoding = toStr(value.get('encoding', 'jpeg'))
+    if RENDER_MODE == 'metadata' and encoding == 'jpeg' and not RENDER_WIDTH:
+        return value['image']
+    img = decodeImage(value, reduced=False)
+    if RENDER_WIDTH and img.shape[1] > RENDER_WIDTH:
+        img = cv2.resize(img, (RENDER_WIDTH, img.shape[0] * RENDER_WIDTH // img.shape[1]), interpolation=cv2.INTER_AREA)
+    elif not img.flags.writeable:
+        img = img.copy()
+    if RENDER_MODE != 'metadata':
+        add_boxes_to_images(img, predictions, classes, detectedProbability)
+    return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, RENDER_QUALITY])[1].tobytes()
+
+# the boxes of the image as json, [label, probability, x1, y1, x2, y2] relative to the size of the image
+def boxesMetadata(predictions, classes, detectedProbability):
+    return json.dumps([[Labels[label], round(float(probability), 4)] + [round(float(c), 4) for c in box[:4]]
+                       for box, label, probability in zip(predictions, classes, detectedProbability)])
 
 # saving the image to Azure blob storage
-def saveImageToAzure(img,blob):
-    try:
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='JPEG')
-        img_byte_arr = img_byte_arr.getvalue()
-        blob.upload_blob(img_byte_arr)
-    except:
-        xlog('saveImageToAzure: error:', sys.exc_info()[0])
+def saveImageToAzure(data,blob):
+    blob.upload_blob(data)
 
-# get public url of the image stored at Azure
-def getBlobUrl(imagename,connectionString):
+# get the client of the Azure blob container, it is created once and reused by every upload,
+# the Azure SDK is imported only then as it takes long to load
+def getContainerClient():
+    global containerClient
+    with containerLock:
+        if containerClient is None:
+            from azure.storage.blob import ContainerClient
+            containerClient = ContainerClient.from_connection_string(conn_str=getSecret("azure_blob_secret"), container_name=ContainerName)
+        return containerClient
+
+# get public url of the image stored at Azure, it is built locally from the container url
+def getBlobUrl(imagename):
+    return getContainerClient().url + '/' + quote(imagename)
+
+# draws the boxes and uploads the image, runs on the upload workers so the gear never waits on Azure
+def uploadImage(value, predictions, classes, detectedProbability, imagename, bloburl):
+    timings = {'draw': 0.0, 'upload': 0.0}
+    boxes = boxesMetadata(predictions, classes, detectedProbability) if RENDER_MODE == 'metadata' else None
     try:
-        container_client = ContainerClient.from_connection_string(conn_str=connectionString, container_name=ContainerName)
-        blob_client = container_client.get_blob_client(imagename) 
-        return blob_client.url
+        start = time.perf_counter()
+        data = renderImage(value, predictions, classes, detectedProbability)
+        timings['draw'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        saveImageToAzure(data, getContainerClient().get_blob_client(imagename))
+        timings['upload'] = time.perf_counter() - start
+        uploadResults.put((imagename, bloburl, None, timings, boxes))
     except:
-        xlog('getBlobUrl: error:', sys.exc_info()[0])
+        uploadResults.put((imagename, bloburl, sys.exc_info(), timings, boxes))
+    finally:
+        uploadSlots.release()
+
+# hands the image over to the upload workers, blocks only when MAX_PENDING_UPLOADS uploads are already queued
+def queueUpload(value, predictions, classes, detectedProbability, imagename):
+    bloburl = getBlobUrl(imagename)
+    uploadSlots.acquire()
+    future = uploadPool.submit(uploadImage, value, predictions, classes, detectedProbability, imagename, bloburl)
+    with pendingLock:
+        pendingUploads.append(future)
+    return bloburl
+
+# store the results of the finished uploads to the uploads Stream, waits for all of them at the end of the inspection,
+# the prediction of an image names its blob in fileName before the upload finished, whether the blob exists is
+# the uploaded field of the uploads entry with the same imagename
+def recordUploads(waitForAll=False):
+    with pendingLock:
+        pending = list(pendingUploads)
+    if waitForAll:
+        wait(pending)
+    with pendingLock:
+        pendingUploads[:] = [f for f in pendingUploads if not f.done()]
+    timings = {'draw': 0.0, 'upload': 0.0}
+    uploaded = 0
+    while not uploadResults.empty():
+        imagename, bloburl, error, uploadTimings, boxes = uploadResults.get()
+        if error:
+            xlog('uploadImage: error:', error)
+        metadata = ['boxes', boxes] if boxes is not None else []
+        execute('xadd', 'uploads', 'MAXLEN', '~', UPLOADS_LENGTH, '*', 'imagename', imagename, 'fileName', bloburl, 'uploaded', '0' if error else '1', *metadata)
+        for stage, seconds in uploadTimings.items():
+            timings[stage] += seconds
+        uploaded += 1
+    if uploaded:
+        recordTimings(uploaded, timings)
 
 # get connection string of the Azure blob from the secret file on the container
 def getSecret(secretName):
@@ -64,98 +199,406 @@ def getSecret(secretName):
     except:
         xlog('getSecret: error:', sys.exc_info())
         
-# get predictions of the different categories in the images from the model trained using Custom Vision at RedisAI 
-def predictImage(x):
+# get the input buffer of the model for the given number of images, the buffers are reused by every execution on the same thread
+def getInputBuffer(count):
+    if not hasattr(buffers, 'inputs'):
+        buffers.inputs = {}
+        buffers.resized = np.empty((320, 320, 3), dtype=np.uint8)
+    if count not in buffers.inputs:
+        if len(buffers.inputs) >= INPUT_BUFFERS:
+            buffers.inputs.pop(next(iter(buffers.inputs)))
+        blob = bytearray(count * 320 * 320 * 3 * 4)
+        buffers.inputs[count] = (blob, np.frombuffer(blob, dtype=np.float32).reshape(count, 320, 320, 3))
+    return buffers.inputs[count]
+
+# pick the reduced jpeg decoding which still keeps the short side of the image at least size pixels
+def getDecodeFlag(width, height, size=320):
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if min(width, height) >= size * factor:
+            return flag
+    return cv2.IMREAD_COLOR
+
+# stream values can come either as bytes or as strings
+def toStr(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+# width and height of the image of the stream entry, read from its header without decoding it
+def getImageSize(value):
+    if toStr(value.get('encoding', 'jpeg')) == 'raw':
+        return int(value['width']), int(value['height'])
+    return Image.open(io.BytesIO(value['image'])).size
+
+# decode the image of the stream entry according to the encoding the drone sent it with,
+# reduced decoding keeps the short side of jpeg images at least size pixels
+def decodeImage(value, reduced=True, size=320):
+    image = value['image']
+    encoding = toStr(value.get('encoding', 'jpeg'))
+    if encoding == 'raw':
+        return np.frombuffer(image, dtype=np.uint8).reshape(int(value['height']), int(value['width']), 3)
+    flag = cv2.IMREAD_COLOR
+    if reduced and encoding == 'jpeg':
+        width, height = getImageSize(value)
+        flag = getDecodeFlag(width, height, size)
+    return cv2.imdecode(np.frombuffer(image, dtype=np.uint8), flag)
+
+# tiles (rows, cols) the frame is split into, (1, 1) runs the model on the whole frame,
+# splitting only pays off when the frame has pixels to spare and, in 'auto' mode, the drone flies high
+def getTileGrid(value, width, height):
+    grid = min(TILE_MAX_GRID, min(width, height) // 320)
+    if TILE_MODE == 'off' or grid < 2:
+        return 1, 1
+    if TILE_MODE == 'auto' and 'positionZ' in value and -float(value['positionZ']) < TILE_MIN_ALTITUDE:
+        return 1, 1
+    if width >= height:
+        return grid, int(round(grid * width / height))
+    return int(round(grid * height / width)), grid
+
+# pixel areas (x0, y0, x1, y1) of the tiles of the image, neighbours overlap by TILE_OVERLAP
+def getTiles(shape, rows, cols):
+    height, width = shape[:2]
+    tileHeight = height / (rows - (rows - 1) * TILE_OVERLAP)
+    tileWidth = width / (cols - (cols - 1) * TILE_OVERLAP)
+    ys = np.linspace(0, height - tileHeight, rows)
+    xs = np.linspace(0, width - tileWidth, cols)
+    return [(int(round(x)), int(round(y)), int(round(x + tileWidth)), int(round(y + tileHeight))) for y in ys for x in xs]
+
+# decode the image of the stream entry at the resolution its tiles need, returns the image and its tiles
+def decodeFrame(x, timings):
+    start = time.perf_counter()
+    value = x['value']
+    width, height = getImageSize(value)
+    rows, cols = getTileGrid(value, width, height)
+    decoded = decodeImage(value, size=320 * min(rows, cols))
+    timings['decode'] += time.perf_counter() - start
+    return decoded, getTiles(decoded.shape, rows, cols)
+
+# resize the area of the image straight into its slot of the input buffer of the model
+def prepareImage(image, out, timings):
+    start = time.perf_counter()
+    resized = buffers.resized
+    if image.shape[:2] == (320, 320):
+        resized[...] = image
+    else:
+        cv2.resize(image, (320, 320), dst=resized, interpolation=cv2.INTER_LINEAR)
+    # the model was fed with images decoded by PIL, so keep the RGB channel order
+    cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=resized)
+    out[...] = resized
+    timings['resize'] += time.perf_counter() - start
+
+# keeps the best of the boxes overlapping by more than NMS_IOU, boxes of different labels never suppress each other
+def suppressBoxes(boxes, scores, classes):
+    # shifting every label by 2 moves its boxes, which lie within 0 and 1, away from the other labels
+    shifted = boxes + classes[:, None] * 2.0
+    areas = (shifted[:, 2] - shifted[:, 0]) * (shifted[:, 3] - shifted[:, 1])
+    order = np.argsort(-scores)
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        widths = np.clip(np.minimum(shifted[best, 2], shifted[rest, 2]) - np.maximum(shifted[best, 0], shifted[rest, 0]), 0, None)
+        heights = np.clip(np.minimum(shifted[best, 3], shifted[rest, 3]) - np.maximum(shifted[best, 1], shifted[rest, 1]), 0, None)
+        overlap = widths * heights
+        order = rest[overlap <= NMS_IOU * (areas[best] + areas[rest] - overlap)]
+    return np.array(keep, dtype=int)
+
+# model results of the tiles of a frame as results of the whole frame
+def mergeTiles(boxes, scores, classes, tiles, shape):
+    height, width = shape[:2]
+    tiles = np.array(tiles, dtype=np.float64)
+    scale = np.column_stack([tiles[:, 2] - tiles[:, 0], tiles[:, 3] - tiles[:, 1]]) / [width, height]
+    offset = tiles[:, :2] / [width, height]
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(len(tiles), -1, 4)
+    merged = boxes * np.tile(scale, 2)[:, None, :] + np.tile(offset, 2)[:, None, :]
+    merged, scores, classes = merged.reshape(-1, 4), np.ravel(scores), np.ravel(classes)
+    keep = np.flatnonzero(scores >= SCORE_THRESHOLD)
+    keep = keep[suppressBoxes(merged[keep], scores[keep], classes[keep])]
+    return merged[keep], scores[keep], classes[keep]
+
+# 64 bit difference hash of the decoded frame, it barely changes between overlapping frames
+def frameHash(image):
+    small = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+# model results of a cached frame close enough to the hash, None when there is none
+def lookupCache(hash):
+    with cacheLock:
+        for cached in reversed(inferenceCache):
+            if bin(cached ^ hash).count('1') <= CACHE_DISTANCE:
+                inferenceCache.move_to_end(cached)
+                return inferenceCache[cached]
+    return None
+
+# keep the model results of the frame, evicting the least recently used ones over CACHE_SIZE
+def storeCache(hash, outputs):
+    with cacheLock:
+        inferenceCache[hash] = outputs
+        inferenceCache.move_to_end(hash)
+        while len(inferenceCache) > CACHE_SIZE:
+            inferenceCache.popitem(last=False)
+
+# run the model trained using Custom Vision at RedisAI on the images, returns the flat outputs and their dims
+def runTensors(blob, count):
+    v1 = redisAI.createTensorFromBlob('FLOAT', [count, 320, 320, 3], blob)
+
+    graphRunner = redisAI.createModelRunner('customvisionmodel')
+    redisAI.modelRunnerAddInput(graphRunner, 'image_tensor', v1)
+    redisAI.modelRunnerAddOutput(graphRunner, 'detected_boxes')
+    redisAI.modelRunnerAddOutput(graphRunner, 'detected_scores')
+    redisAI.modelRunnerAddOutput(graphRunner, 'detected_classes')
+
+    res = redisAI.modelRunnerRun(graphRunner)
+    return [redisAI.tensorToFlatList(tensor) for tensor in res], [redisAI.tensorGetDims(tensor) for tensor in res]
+
+# run the model once for the whole batch of images
+def runModel(blob, count):
+    return runBatch(runTensors, blob, count)
+
+# set once the model dropped the batch from its outputs or failed on a batch, later batches go straight to one run per image
+singleImageModel = False
+
+# runs the model on the batch through runner(blob, count), which returns the flat outputs and their dims,
+# the first time the model does not keep the batch in its outputs or fails on it every image is run on its own from then on
+def runBatch(runner, blob, count):
+    global singleImageModel
+    if count > 1 and not singleImageModel:
         try:
-            detectedProbability = np.array([]) 
-            detectedClasses = np.array([])
-            bloburl = ''
-            if x['value']['image']:
-                image_data = io.BytesIO(x['value']['image'])
-                image = Image.open(image_data)
-                numpy_img = np.array(image)
-                resize_img = cv2.resize(numpy_img, (320, 320), interpolation=cv2.INTER_LINEAR)
-                inputs = np.array(resize_img, dtype=np.float32)[np.newaxis, :, :, :]
-                img_ba = bytearray(inputs.tobytes())
-                v1 = redisAI.createTensorFromBlob('FLOAT', [1, 320, 320, 3], img_ba)
-
-                graphRunner = redisAI.createModelRunner('customvisionmodel')
-                redisAI.modelRunnerAddInput(graphRunner, 'image_tensor', v1)
-                redisAI.modelRunnerAddOutput(graphRunner, 'detected_boxes')
-                redisAI.modelRunnerAddOutput(graphRunner, 'detected_scores')
-                redisAI.modelRunnerAddOutput(graphRunner, 'detected_classes')
-
-                res = redisAI.modelRunnerRun(graphRunner)
-
-                res1 = redisAI.tensorToFlatList(res[0])
-                res2 = redisAI.tensorToFlatList(res[1])
-                res3 = redisAI.tensorToFlatList(res[2])
-            
-                deleteLowProbResult = []
-                for idx,prediction in enumerate(res2):
-                    if(prediction < 0.5):
-                        deleteLowProbResult.append(idx)
-
-                array_2d_rowcount = int(len(res1)/4)
-                arr_2d = np.reshape(res1, (array_2d_rowcount, 4))
-
-                detectedBoxes = np.delete(arr_2d, deleteLowProbResult, axis=0)
-                detectedProbability =  np.delete(res2, deleteLowProbResult)
-                detectedClasses = np.delete(res3, deleteLowProbResult)
-                
-                imagename = x['value']['imagename']
-                connectionString = getSecret("azure_blob_secret")
-                blob = BlobClient.from_connection_string(conn_str=connectionString, container_name=ContainerName, blob_name=imagename)
-                add_boxes_to_images(image, detectedBoxes, detectedClasses, blob, detectedProbability)
-                bloburl = getBlobUrl(imagename,connectionString)
-            
-            weatherCondition = x['value']['weather']
-            windSpeed = x['value']['windSpeed']
-            isDone = x['value']['isDone']
-            return detectedProbability,detectedClasses,bloburl,weatherCondition,windSpeed,isDone
-        except:
-            xlog('Predict_image: error:', sys.exc_info())
-
-# store the modelled results returned by the Redis AI to the Redis Stream
+            outputs = splitOutputs(*runner(blob, count), count)
+        except Exception:
+            xlog('runModel: error on a batch of', count, 'images, running one image at a time:', sys.exc_info())
+            outputs = None
+        if outputs is not None:
+            return outputs
+        singleImageModel = True
+    return runEach(lambda image: splitOutputs(*runner(image, 1), 1), blob, count)
+
+# splits the outputs of one run over count images back per image, None when their dims do not start with count,
+# which is what a model exported for a single image returns for a batch
+def splitOutputs(outputs, dims, count):
+    if count > 1 and any(len(shape) < 2 or shape[0] != count for shape in dims):
+        return None
+    boxes = np.reshape(outputs[0], (count, -1, 4))
+    scores = np.reshape(outputs[1], (count, -1))
+    classes = np.reshape(outputs[2], (count, -1)).astype(int)
+    return boxes, scores, classes
+
+# runs the model once for every image of the blob through runImage and stacks the results, the images with fewer boxes
+# are padded with boxes scoring -1, which never pass SCORE_THRESHOLD
+def runEach(runImage, blob, count):
+    size = len(blob) // count
+    results = [runImage(blob[i * size:(i + 1) * size]) for i in range(count)]
+    most = max(scores.shape[1] for boxes, scores, classes in results)
+    boxes = np.zeros((count, most, 4))
+    scores = np.full((count, most), -1.0)
+    classes = np.zeros((count, most), dtype=int)
+    for i, (imageBoxes, imageScores, imageClasses) in enumerate(results):
+        found = imageScores.shape[1]
+        boxes[i, :found] = imageBoxes[0]
+        scores[i, :found] = imageScores[0]
+        classes[i, :found] = imageClasses[0]
+    return boxes, scores, classes
+
+# ground positions (latitude, longitude) of the centres of the boxes, the camera looks straight down
+# with the top of the image pointing where the drone heads
+def projectBoxes(value, boxes, aspect):
+    height = -float(value['positionZ'])
+    yaw = float(value['yaw'])
+    latitude = float(value['latitude'])
+    longitude = float(value['longitude'])
+
+    groundWidth = 2 * max(height, 0) * np.tan(np.radians(CAMERA_FOV) / 2)
+    groundHeight = groundWidth * aspect
+    centres = (boxes[:, :2] + boxes[:, 2:]) / 2
+    forward = (0.5 - centres[:, 1]) * groundHeight
+    right = (centres[:, 0] - 0.5) * groundWidth
+    north = forward * np.cos(yaw) - right * np.sin(yaw)
+    east = forward * np.sin(yaw) + right * np.cos(yaw)
+
+    latitudes = latitude + np.degrees(north / EARTH_RADIUS)
+    longitudes = longitude + np.degrees(east / (EARTH_RADIUS * np.cos(np.radians(latitude))))
+    return latitudes, longitudes
+
+# name of the Redis geo set holding the detections of the label found during the inspection
+def detectionsKey(inspectionId, label):
+    return DETECTIONS_KEY + inspectionId + ':' + label
+
+# store the detections of the image in the Redis geo index of its inspection and their label and return them as
+# [label, score, latitude, longitude] for the prediction of the image
+def indexDetections(value, boxes, classes, scores, aspect):
+    latitudes, longitudes = projectBoxes(value, boxes, aspect)
+    imagename = toStr(value['imagename'])
+    inspectionId = toStr(value.get('inspectionId', ''))
+    for label in np.unique(classes):
+        members = []
+        for i in np.flatnonzero(classes == label):
+            members += [float(longitudes[i]), float(latitudes[i]), imagename + '|' + str(i) + '|' + str(round(float(scores[i]), 4))]
+        key = detectionsKey(inspectionId, Labels[label])
+        execute('geoadd', key, *members)
+        execute('expire', key, DETECTIONS_TTL)
+    return [[Labels[label], round(float(score), 4), float(latitude), float(longitude)] for label, score, latitude, longitude in zip(classes, scores, latitudes, longitudes)]
+
+# store how long each stage took summed over the frames in the Redis timings Stream, the drones export it to InfluxDB,
+# the hit rate of the cache is hits / (hits + misses) of CACHE_STATS_KEY
+def recordTimings(frames, timings, cached=None):
+    fields = sum([[stage, round(seconds * 1000, 3)] for stage, seconds in timings.items()], [])
+    if cached is not None:
+        fields += ['cached', cached]
+    execute('xadd', 'timings', 'MAXLEN', '~', TIMINGS_LENGTH, '*', 'frames', frames, *fields)
+    if cached is not None and CACHE_SIZE:
+        execute('hincrby', CACHE_STATS_KEY, 'hits', cached)
+        execute('hincrby', CACHE_STATS_KEY, 'misses', frames - cached)
+
+# collect the stream entries read by one execution into a single batch
+def collectFrames(a, r):
+    a = a if a else []
+    a.append(r)
+    return a
+
+# get predictions of the different categories in the images from the model trained using Custom Vision at RedisAI 
+def predictImages(batch):
+    try:
+        timings = {'decode': 0.0, 'resize': 0.0, 'model': 0.0, 'postprocess': 0.0}
+        results = [(np.array([]), np.array([]), '') for x in batch]
+        framed = [idx for idx,x in enumerate(batch) if x['value']['image']]
+
+        if framed:
+            # frames found in the cache reuse its results, the others need the model for each of their tiles
+            outputs = {}
+            hashes = {}
+            pending = []
+            aspects = {}
+            for pos,idx in enumerate(framed):
+                try:
+                    decoded, tiles = decodeFrame(batch[idx], timings)
+                except:
+                    xlog('Predict_image: error:', sys.exc_info())
+                    continue
+                aspects[pos] = decoded.shape[0] / decoded.shape[1]
+                if CACHE_SIZE:
+                    hashes[pos] = frameHash(decoded)
+                    outputs[pos] = lookupCache(hashes[pos])
+                if outputs.get(pos) is None:
+                    pending.append((pos, decoded, tiles))
+            cached = len(aspects) - len(pending)
+
+            if pending:
+                # the tiles of all frames go to the model in one run
+                blob, inputs = getInputBuffer(sum(len(tiles) for pos, decoded, tiles in pending))
+                slot = 0
+                for pos, decoded, tiles in pending:
+                    for x0, y0, x1, y1 in tiles:
+                        prepareImage(decoded[y0:y1, x0:x1], inputs[slot], timings)
+                        slot += 1
+                start = time.perf_counter()
+                boxes, scores, classes = runModel(blob, slot)
+                timings['model'] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                slot = 0
+                for pos, decoded, tiles in pending:
+                    if len(tiles) == 1:
+                        outputs[pos] = (boxes[slot], scores[slot], classes[slot])
+                    else:
+                        outputs[pos] = mergeTiles(boxes[slot:slot + len(tiles)], scores[slot:slot + len(tiles)],
+                                                  classes[slot:slot + len(tiles)], tiles, decoded.shape)
+                    slot += len(tiles)
+                    if CACHE_SIZE:
+                        storeCache(hashes[pos], outputs[pos])
+                timings['postprocess'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            for pos in aspects:
+                frameBoxes, frameScores, frameClasses = outputs[pos]
+                keep = frameScores >= SCORE_THRESHOLD
+                detectedBoxes = frameBoxes[keep]
+                detectedProbability = frameScores[keep]
+                detectedClasses = frameClasses[keep]
+
+                idx = framed[pos]
+                imagename = batch[idx]['value']['imagename']
+                bloburl = queueUpload(batch[idx]['value'], detectedBoxes, detectedClasses, detectedProbability, imagename)
+                if 'latitude' in batch[idx]['value'] and len(detectedBoxes):
+                    # the ground positions of the detections go with the prediction for the heat maps
+                    batch[idx]['value']['detections'] = json.dumps(indexDetections(batch[idx]['value'], detectedBoxes, detectedClasses, detectedProbability, aspects[pos]))
+                results[idx] = (detectedProbability, detectedClasses, bloburl)
+            timings['postprocess'] += time.perf_counter() - start
+            recordTimings(len(aspects), timings, cached)
+
+        return [results[idx] + (x['value']['weather'], x['value']['windSpeed'], x['value']['isDone'], x['value']) for idx,x in enumerate(batch)]
+    except:
+        xlog('Predict_image: error:', sys.exc_info())
+        # every record still gets an empty prediction, so a failed batch never loses the isDone row of its inspection
+        return [(np.array([]), np.array([]), '', x['value'].get('weather', ''), x['value'].get('windSpeed', 0), x['value'].get('isDone', '0'), x['value']) for x in batch]
+
+# store the modelled results returned by the Redis AI to the Redis Stream, tells whether the prediction was written
 def addToStream(x):
     try:
-        detectedProbabilities =  x[0].tolist()
-        detectedClasses = x[1].tolist()
+        detectedProbabilities = np.asarray(x[0], dtype=np.float64)
+        detectedClasses = np.asarray(x[1]).astype(int)
         bloburl = x[2]
         weatherCondition = x[3]
         windSpeed = x[4]
         isDone = x[5]
-        
-        result = []
-        streamResult = []
-
-        for idx,prediction in enumerate(detectedClasses):
-            result.append([Labels[prediction],detectedProbabilities[idx] * 100])
-
-        for idx,label in enumerate(Labels):
-            if not idx in detectedClasses:
-                result.append([label,0])
-        
-        df = pd.DataFrame(result)
-        result = df.groupby(0)[1].mean()
 
-        for (columnName, columnData) in result.iteritems():
-            streamResult.append([columnName,columnData])
+        # mean probability in percent of every label, labels which were not detected get 0
+        counts = np.bincount(detectedClasses, minlength=len(Labels))
+        sums = np.bincount(detectedClasses, weights=detectedProbabilities * 100, minlength=len(Labels))
+        means = sums / np.maximum(counts, 1)
 
+        streamResult = [[label, mean] for label, mean in zip(Labels, means.tolist())]
         streamResult.append(['fileName',bloburl])
         streamResult.append(['isDone',isDone])
         streamResult.append(['weather',weatherCondition])
         streamResult.append(['windSpeed',windSpeed])
-        redisgears.executeCommand('xadd', 'predictions', '*',*sum(streamResult, []))
+        # where the image was taken, when the drone sent its pose
+        if 'latitude' in x[6]:
+            streamResult.append(['latitude',x[6]['latitude']])
+            streamResult.append(['longitude',x[6]['longitude']])
+        # which frame of which inspection the prediction belongs to, so predictions can be archived by inspection,
+        # and where on the ground its detections are
+        for field in ('inspectionId', 'imagename', 'vehicle', 'captureTime', 'detections'):
+            if field in x[6]:
+                streamResult.append([field, x[6][field]])
+        # the inspection is done only once the blobs of all its images are uploaded and recorded
+        if toStr(isDone) == '1':
+            recordUploads(True)
+        start = time.perf_counter()
+        publishPrediction(x, sum(streamResult, []))
+        timings = {'result': time.perf_counter() - start}
+        # latency from the capture of the frame on the drone to its prediction, both clocks are synchronised by the host
+        if 'captureTime' in x[6]:
+            timings['latency'] = time.time() - float(x[6]['captureTime'])
+        recordTimings(1, timings)
+        recordUploads()
+        return True
     except:
         xlog('addToStream: error:', sys.exc_info())
+        return False
 
 # store the exception logs in the Redis Log Stream
 def xlog(*args):
-    redisgears.executeCommand('xadd', 'log', '*', 'text', ' '.join(map(str, args)))
+    execute('xadd', 'log', '*', 'text', ' '.join(map(str, args)))
+
+# runs a redis command, inside of RedisGears it goes straight to the shard
+def execute(*args):
+    return redisgears.executeCommand(*args)
+
+# writes the fields of the prediction of one image to the predictions Stream
+def publishPrediction(x, fields):
+    execute('xadd', 'predictions', '*', *fields)
+
+# lets worker.py run the gear logic with its own redis connection, model runner and ordered prediction writer
+def useBackend(executeCommand, modelRunner, predictionWriter):
+    global execute, runModel, publishPrediction
+    execute = executeCommand
+    runModel = modelRunner
+    publishPrediction = predictionWriter
 
-# Registeration of the stream with the Redis Gears
-GearsBuilder('StreamReader').\
-    map(predictImage).\
-    foreach(addToStream).\
-    register('inspectiondata')
\ No newline at end of file
+# Registeration of the stream with the Redis Gears, processed entries are trimmed from the stream which makes room
+# for the frames the drones hold back to stay within STREAM_MEMORY_BUDGET
+if redisgears is not None:
+    GearsBuilder('StreamReader').\
+        accumulate(collectFrames).\
+        flatmap(predictImages).\
+        foreach(addToStream).\
+        register('inspectiondata', batch=BATCH_SIZE, duration=BATCH_DURATION, trimStream=True)
\ No newline at end of file
@@ -0,0 +1,126 @@
+import os
+import json
+import argparse
+import cv2
+import numpy as np
+from gearconsumer import Labels, EARTH_RADIUS
+from init import connect_redis
+
+# directory holding the rasters and the id of the last aggregated prediction
+HEATMAP_DIR = os.environ.get('HEATMAP_DIR', 'heatmaps')
+# centre of the mapped area, the home position of AirSim by default
+HEATMAP_LATITUDE = float(os.environ.get('HEATMAP_LATITUDE', 47.641468))
+HEATMAP_LONGITUDE = float(os.environ.get('HEATMAP_LONGITUDE', -122.140165))
+# size of one cell in metres and number of cells along each side of the area
+CELL_SIZE = float(os.environ.get('HEATMAP_CELL_SIZE', 1.0))
+GRID_SIZE = int(os.environ.get('HEATMAP_GRID_SIZE', 1024))
+# side of an exported tile in cells
+TILE_SIZE = 256
+# predictions read from the stream at once
+READ_COUNT = 500
+
+# per label rasters of the summed scores of the detections and one raster of their number, memory mapped so they survive restarts
+class HeatMap:
+    def __init__(self, directory=HEATMAP_DIR, latitude=HEATMAP_LATITUDE, longitude=HEATMAP_LONGITUDE, cellSize=CELL_SIZE, gridSize=GRID_SIZE):
+        self.directory = directory
+        self.latitude = latitude
+        self.longitude = longitude
+        self.cellSize = cellSize
+        self.gridSize = gridSize
+        os.makedirs(directory, exist_ok=True)
+        self.sums = {label: self.openRaster(label) for label in Labels}
+        self.counts = self.openRaster('count')
+        self.lastId = '0'
+        statePath = os.path.join(directory, 'state.json')
+        if os.path.exists(statePath):
+            with open(statePath) as f:
+                self.lastId = json.load(f)['lastId']
+
+    def openRaster(self, name):
+        path = os.path.join(self.directory, name + '.npy')
+        mode = 'r+' if os.path.exists(path) else 'w+'
+        return np.lib.format.open_memmap(path, mode=mode, dtype=np.float32, shape=(self.gridSize, self.gridSize))
+
+    # cells (row, col) of the positions, row grows to the north and col to the east, positions off the grid give -1
+    def cells(self, latitudes, longitudes):
+        north = np.radians(latitudes - self.latitude) * EARTH_RADIUS
+        east = np.radians(longitudes - self.longitude) * EARTH_RADIUS * np.cos(np.radians(self.latitude))
+        rows = np.floor(north / self.cellSize + self.gridSize / 2).astype(int)
+        cols = np.floor(east / self.cellSize + self.gridSize / 2).astype(int)
+        inside = (rows >= 0) & (rows < self.gridSize) & (cols >= 0) & (cols < self.gridSize)
+        return np.where(inside, rows, -1), np.where(inside, cols, -1)
+
+    # adds the detections of the predictions read from the stream, each one at the ground position of the centre of its box
+    # as projected by the gear, predictions without detections add nothing
+    def update(self, entries):
+        detections = [detection for entryId, fields in entries for detection in json.loads(fields.get(b'detections', b'[]'))]
+        if detections:
+            labels, scores, latitudes, longitudes = zip(*detections)
+            rows, cols = self.cells(np.array(latitudes), np.array(longitudes))
+            inside = rows >= 0
+            labels, scores = np.array(labels)[inside], np.array(scores)[inside] * 100
+            rows, cols = rows[inside], cols[inside]
+            np.add.at(self.counts, (rows, cols), 1)
+            for label in Labels:
+                same = labels == label
+                np.add.at(self.sums[label], (rows[same], cols[same]), scores[same])
+        if entries:
+            self.lastId = entries[-1][0].decode()
+
+    # writes the rasters and then the id of the last aggregated prediction, so a restart resumes right after it,
+    # the counting is at least once: a crash between the two adds the last predictions again after the restart
+    def flush(self):
+        for raster in list(self.sums.values()) + [self.counts]:
+            raster.flush()
+        statePath = os.path.join(self.directory, 'state.json')
+        with open(statePath + '.tmp', 'w') as f:
+            json.dump({'lastId': self.lastId}, f)
+        os.replace(statePath + '.tmp', statePath)
+
+    # mean score in percent of the label over the detections in every cell of the tile, a label scores 0 in the cells
+    # where only other labels were detected, nan where nothing was detected
+    def tile(self, label, tileRow, tileCol, size=TILE_SIZE):
+        area = (slice(tileRow * size, (tileRow + 1) * size), slice(tileCol * size, (tileCol + 1) * size))
+        counts = self.counts[area]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(counts > 0, self.sums[label][area] / counts, np.nan)
+
+    # the tile as a png image, north up and cells without predictions transparent
+    def tilePng(self, label, tileRow, tileCol, size=TILE_SIZE):
+        means = np.flipud(self.tile(label, tileRow, tileCol, size))
+        seen = ~np.isnan(means)
+        colours = cv2.applyColorMap(np.clip(np.nan_to_num(means) * 2.55, 0, 255).astype(np.uint8), cv2.COLORMAP_JET)
+        image = np.dstack([colours, np.where(seen, 255, 0).astype(np.uint8)])
+        return cv2.imencode('.png', image)[1].tobytes()
+
+# keeps the heat map up to date with the predictions stream, continuing from the last aggregated prediction
+def run():
+    conn = connect_redis()
+    heatMap = HeatMap()
+    print("Aggregating predictions after " + heatMap.lastId)
+    while True:
+        res = conn.execute_command('xread', 'COUNT', READ_COUNT, 'BLOCK', 5000, 'STREAMS', 'predictions', heatMap.lastId)
+        if res:
+            heatMap.update(res[0][1])
+            heatMap.flush()
+
+# writes the tile of the label as a png, or keeps the heat map up to date when no tile is asked for
+def main():
+    parser = argparse.ArgumentParser(description='Aggregates the detections of the predictions stream into heat maps')
+    parser.add_argument('--tile', nargs=3, metavar=('LABEL', 'ROW', 'COL'), help='export the tile of the label instead of aggregating')
+    parser.add_argument('--size', type=int, default=TILE_SIZE, help='side of the tile in cells')
+    parser.add_argument('--out', help='png file the tile is written to, LABEL-ROW-COL.png by default')
+    args = parser.parse_args()
+    if args.tile is None:
+        run()
+        return
+    label, tileRow, tileCol = args.tile[0], int(args.tile[1]), int(args.tile[2])
+    if label not in Labels:
+        parser.error('LABEL must be one of ' + ', '.join(Labels))
+    out = args.out or label + '-' + str(tileRow) + '-' + str(tileCol) + '.png'
+    with open(out, 'wb') as f:
+        f.write(HeatMap().tilePng(label, tileRow, tileCol, args.size))
+    print("Tile written to " + out)
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,108 @@
+import os
 import redis
+import time
+import random
+import hashlib
 
-def connect_redis():
-    t = None
+# key of the model in RedisAI
+MODEL_KEY = 'customvisionmodel'
+# id of the session of the gear in RedisGears, redeploying the gear replaces the session with this id
+GEAR_ID = 'havran'
+# requirements exported from an online RedisGears by RG.PYEXPORTREQ (e.g. gears-cli export-requirements),
+# they are imported before the gear is deployed so RedisGears does not download and build them again
+GEAR_WHEELS_DIR = 'gear_wheels'
+# size of one chunk of an imported requirement
+IMPORT_CHUNK_SIZE = 10 * 1024 * 1024
+
+# connects to redis, retrying with exponential backoff and jitter instead of spinning
+def connect_redis(timeout=None, initialDelay=0.05, maxDelay=5.0):
+    start = time.monotonic()
+    delay = initialDelay
+    while True:
+        try:
+            tempConn = redis.Redis(host="redismod", port=6379)
+            tempConn.ping()
+            print("Connected to Redis at redismod:6379 after " + str(round(time.monotonic() - start, 2)) + " s")
+            return tempConn
+        except redis.exceptions.ConnectionError:
+            if delay == initialDelay:
+                print("Can't connect to Redis at redismod:6379")
+            if timeout is not None and time.monotonic() - start >= timeout:
+                raise
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, maxDelay)
+
+# stream values can come either as bytes or as strings
+def toStr(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+# tag of the model stored in RedisAI, None when there is no model yet
+def getModelTag(conn):
+    try:
+        meta = conn.execute_command('AI.MODELGET', MODEL_KEY, 'META')
+    except redis.exceptions.ResponseError:
+        return None
+    return toStr(dict(zip(meta[::2], meta[1::2])).get(b'tag'))
+
+# fields of the session of the gear in RedisGears, None when the gear is not deployed
+def getGearSession(conn):
     try:
-        tempConn = redis.Redis(host="redismod", port=6379)
-        t = tempConn.ping()
-    except: 
-        print("Can't connect to Redis at redismod:6379")
-        while t is None:
-            try:
-                tempConn = redis.Redis(host="redismod", port=6379)
-                t = tempConn.ping()
-            except:
-                pass
-    return tempConn
+        sessions = conn.execute_command('RG.PYDUMPSESSIONS', 'SESSIONS', GEAR_ID)
+    except redis.exceptions.ResponseError:
+        return None
+    if not sessions:
+        return None
+    session = sessions[0]
+    return dict(zip(session[::2], session[1::2]))
+
+# description of the session of the gear in RedisGears, None when the gear is not deployed
+def getGearDescription(conn):
+    session = getGearSession(conn)
+    return toStr(session.get(b'sessionDescription')) if session is not None else None
+
+# unregisters the gear left by an earlier run, RedisGears drops its session together with its last registration
+def removeGear(conn):
+    session = getGearSession(conn)
+    if session is None:
+        return
+    for registration in session.get(b'registrations') or []:
+        conn.execute_command('RG.UNREGISTER', toStr(registration))
+    print("Gear " + str(toStr(session.get(b'sessionDescription')))[:12] + " unregistered")
+
+# uploads the model unless RedisAI already holds the same one, the hash of the model is kept as its tag
+def deployModel(conn, model):
+    digest = hashlib.sha256(model).hexdigest()
+    if getModelTag(conn) == digest:
+        print("Model " + digest[:12] + " is already loaded")
+        return
+    result = conn.execute_command('AI.MODELSET', MODEL_KEY, 'TF', 'CPU', 'TAG', digest, 'INPUTS', 'image_tensor', 'OUTPUTS', 'detected_boxes','detected_scores','detected_classes','BLOB', model)
+    print("Model " + digest[:12] + " loaded: " + str(result))
+
+# imports the exported requirements found in GEAR_WHEELS_DIR
+def importRequirements(conn):
+    if not os.path.isdir(GEAR_WHEELS_DIR):
+        return
+    for name in sorted(os.listdir(GEAR_WHEELS_DIR)):
+        if not name.endswith('.zip'):
+            continue
+        with open(os.path.join(GEAR_WHEELS_DIR, name), 'rb') as f:
+            data = f.read()
+        chunks = [data[i:i + IMPORT_CHUNK_SIZE] for i in range(0, len(data), IMPORT_CHUNK_SIZE)]
+        print("Importing requirement " + name + ": " + str(conn.execute_command('RG.PYIMPORTREQ', *chunks)))
+
+# registers the gear unless the same code with the same requirements already runs, the hash of both is kept
+# as the description of its session and a changed gear replaces the old session
+def deployGear(conn, gear_functions, requirements):
+    digest = hashlib.sha256(gear_functions + b''.join(requirements)).hexdigest()
+    description = getGearDescription(conn)
+    if description == digest:
+        print("Gear " + digest[:12] + " is already registered")
+        return
+    importRequirements(conn)
+    upgrade = ['UPGRADE'] if description is not None else []
+    requirements = [r.strip() for r in requirements if r.strip()]
+    result = conn.execute_command('RG.PYEXECUTE', gear_functions, 'ID', GEAR_ID, 'DESCRIPTION', digest, *upgrade, 'REQUIREMENTS', *requirements)
+    print("Gear " + digest[:12] + " registered: " + str(result))
 
 if __name__ == '__main__':
     conn = connect_redis()
@@ -29,12 +118,15 @@ if __name__ == '__main__':
     requirements_file.close()
     
     # Loads the AI model to redis
-    result = conn.execute_command('AI.MODELSET', 'customvisionmodel', 'TF', 'CPU', 'INPUTS', 'image_tensor', 'OUTPUTS', 'detected_boxes','detected_scores','detected_classes','BLOB', model)
-    print(result)
+    deployModel(conn, model)
     
-    # Loads the Gear to register with the inspectiondata stream
-    result = conn.execute_command('RG.PYEXECUTE', gear_functions, 'REQUIREMENTS', *requirements)
-    print(result)
+    # Loads the Gear to register with the inspectiondata stream, in scale out mode worker.py processes read the stream instead
+    # and a gear registered by an earlier run is removed, otherwise it would predict every frame a second time
+    if os.environ.get('SCALE_OUT'):
+        print("Scale out mode, the inspectiondata stream is processed by worker.py")
+        removeGear(conn)
+    else:
+        deployGear(conn, gear_functions, requirements)
 """
     # Keeps this vode running (for aesthetic reasons)
     while(True):
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import socket
+import numpy as np
+import redis
+import gearconsumer
+from init import connect_redis
+
+# consumer group shared by all workers reading the inspectiondata stream
+GROUP = 'PredictionGroup'
+# name of this worker in the consumer group
+CONSUMER = os.environ.get('WORKER_NAME', socket.gethostname() + '-' + str(os.getpid()))
+# maximum number of entries read and sent to the model at once
+BATCH_SIZE = int(os.environ.get('WORKER_BATCH_SIZE', gearconsumer.BATCH_SIZE))
+# maximum time in ms a read waits for new entries
+BLOCK_MS = int(os.environ.get('WORKER_BLOCK_MS', gearconsumer.BATCH_DURATION))
+# entries pending for longer than this many ms belong to a crashed worker and are claimed by another one
+CLAIM_IDLE_MS = int(os.environ.get('WORKER_CLAIM_IDLE_MS', 60000))
+# seconds between two attempts to claim entries of crashed workers
+CLAIM_INTERVAL = 10
+# predictions waiting behind a missing frame of an inspection before the frame is given up on
+REORDER_WINDOW = 20
+# seconds the reorder state of an inspection is kept after its last prediction
+REORDER_TTL = 86400
+# seconds after the last prediction of an inspection when everything still waiting in its reorder buffer is sent
+REORDER_TIMEOUT = int(os.environ.get('WORKER_REORDER_TIMEOUT', 30))
+
+# numpy types of the RedisAI tensor types
+TensorTypes = {b'FLOAT': np.float32, b'DOUBLE': np.float64, b'INT8': np.int8, b'INT16': np.int16, b'INT32': np.int32,
+               b'INT64': np.int64, b'UINT8': np.uint8, b'UINT16': np.uint16, b'BOOL': np.bool_}
+
+# keeps the predictions of every inspection in the order of their frames, no matter which worker finished first,
+# a 'flush' call sends everything still waiting once nothing was added for the timeout, so a frame whose entry was lost
+# never holds back the end of the inspection for good
+# KEYS: reorder buffer, next expected seq, predictions stream, time of the last prediction added.
+# ARGV: seq, json encoded fields, window, ttl, 'add' or 'flush', timeout in seconds
+ORDERED_XADD = """
+redis.replicate_commands()
+local now = tonumber(redis.call('TIME')[1])
+local nextSeq = tonumber(redis.call('GET', KEYS[2]) or '1')
+local flushAll = false
+if ARGV[5] == 'flush' then
+    if now - tonumber(redis.call('GET', KEYS[4]) or '0') < tonumber(ARGV[6]) then
+        return 0
+    end
+    flushAll = true
+else
+    if tonumber(ARGV[1]) < nextSeq then
+        -- the frame was already given up on, its prediction still goes out, only late
+        redis.call('XADD', KEYS[3], '*', unpack(cjson.decode(ARGV[2])))
+        return 1
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('SET', KEYS[4], now, 'EX', ARGV[4])
+end
+local emitted = 0
+while true do
+    local fields = redis.call('HGET', KEYS[1], tostring(nextSeq))
+    if not fields then
+        local waiting = redis.call('HLEN', KEYS[1])
+        if waiting == 0 or (not flushAll and waiting < tonumber(ARGV[3])) then
+            break
+        end
+        -- too many predictions wait behind the missing frame, skip to the oldest one waiting
+        local lowest = nil
+        for _, seq in ipairs(redis.call('HKEYS', KEYS[1])) do
+            if not lowest or tonumber(seq) < lowest then
+                lowest = tonumber(seq)
+            end
+        end
+        nextSeq = lowest
+        fields = redis.call('HGET', KEYS[1], tostring(nextSeq))
+    end
+    redis.call('XADD', KEYS[3], '*', unpack(cjson.decode(fields)))
+    redis.call('HDEL', KEYS[1], tostring(nextSeq))
+    nextSeq = nextSeq + 1
+    emitted = emitted + 1
+end
+redis.call('SET', KEYS[2], nextSeq, 'EX', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return emitted
+"""
+
+# runs the model with the RedisAI commands, all in one round trip, returns the flat outputs and their dims
+def runTensors(conn, blob, count):
+    keys = ['{worker:' + CONSUMER + '}:' + name for name in ('image_tensor', 'detected_boxes', 'detected_scores', 'detected_classes')]
+    pipe = conn.pipeline(transaction=False)
+    pipe.execute_command('AI.TENSORSET', keys[0], 'FLOAT', count, 320, 320, 3, 'BLOB', memoryview(blob))
+    pipe.execute_command('AI.MODELEXECUTE', 'customvisionmodel', 'INPUTS', 1, keys[0], 'OUTPUTS', 3, *keys[1:])
+    for key in keys[1:]:
+        pipe.execute_command('AI.TENSORGET', key, 'META', 'BLOB')
+    pipe.execute_command('DEL', *keys)
+    res = pipe.execute()[2:5]
+
+    outputs = []
+    dims = []
+    for tensor in res:
+        meta = dict(zip(tensor[::2], tensor[1::2]))
+        outputs.append(np.frombuffer(meta[b'blob'], dtype=TensorTypes[meta[b'dtype']]))
+        dims.append(meta[b'shape'])
+    return outputs, dims
+
+# runs the model on the batch, or on every image on its own once the model turned out not to take batches
+def runModel(conn, blob, count):
+    return gearconsumer.runBatch(lambda part, n: runTensors(conn, part, n), blob, count)
+
+# writes the prediction through the reorder buffer of its inspection and vehicle, entries without a sequence number go straight out
+def publishPrediction(conn, orderedXadd, x, fields):
+    value = x[6]
+    if 'seq' not in value or 'inspectionId' not in value:
+        conn.execute_command('xadd', 'predictions', '*', *fields)
+        return
+    # every vehicle numbers its frames on its own
+    source = gearconsumer.toStr(value['inspectionId'])
+    if 'vehicle' in value:
+        source += ':' + gearconsumer.toStr(value['vehicle'])
+    fields = [str(gearconsumer.toStr(field)) for field in fields]
+    orderedXadd(keys=reorderKeys(source), args=[int(value['seq']), json.dumps(fields), REORDER_WINDOW, REORDER_TTL, 'add', REORDER_TIMEOUT])
+
+# keys of the reorder state of one inspection and vehicle
+def reorderKeys(source):
+    return ['predictions:reorder:' + source, 'predictions:next:' + source, 'predictions', 'predictions:updated:' + source]
+
+# sends what waits in the reorder buffers of inspections which got no prediction for REORDER_TIMEOUT seconds
+def flushReorderBuffers(conn, orderedXadd):
+    for key in conn.scan_iter(match='predictions:reorder:*'):
+        orderedXadd(keys=reorderKeys(gearconsumer.toStr(key)[len('predictions:reorder:'):]),
+                    args=[0, '[]', REORDER_WINDOW, REORDER_TTL, 'flush', REORDER_TIMEOUT])
+
+# creates the consumer group, reading the stream from its start so nothing already waiting is lost
+def createGroup(conn):
+    try:
+        conn.execute_command('xgroup', 'CREATE', 'inspectiondata', GROUP, '0', 'MKSTREAM')
+    except redis.exceptions.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+# converts entries returned by redis to the records the gear works with
+def toRecords(entries):
+    return [{'key': 'inspectiondata', 'id': entryId, 'value': {gearconsumer.toStr(k): v for k, v in fields.items()}}
+            for entryId, fields in entries if fields is not None]
+
+# takes over entries which other workers read but never acknowledged, entries deleted meanwhile come back without fields
+def claimEntries(conn):
+    ids = conn.xautoclaim('inspectiondata', GROUP, CONSUMER, CLAIM_IDLE_MS, '0-0', count=BATCH_SIZE, justid=True)
+    pipe = conn.pipeline(transaction=False)
+    for entryId in ids:
+        pipe.execute_command('xrange', 'inspectiondata', entryId, entryId)
+    return [(entryId, found[0][1] if found else None) for entryId, found in zip(ids, pipe.execute())]
+
+# predicts the images of the entries, then acknowledges and deletes them once their predictions are written,
+# which frees the memory budget of the stream for the frames the drones hold back
+def processEntries(conn, entries):
+    records = toRecords(entries)
+    if records:
+        published = set()
+        for result in gearconsumer.predictImages(records):
+            if gearconsumer.addToStream(result):
+                published.add(id(result[6]))
+        # a frame without a prediction would hold back the later ones of its inspection, it gets an empty one instead
+        for record in records:
+            value = record['value']
+            if id(value) not in published:
+                gearconsumer.addToStream(([], [], '', value.get('weather', ''), value.get('windSpeed', 0), value.get('isDone', '0'), value))
+    ids = [entryId for entryId, fields in entries]
+    pipe = conn.pipeline(transaction=False)
+    pipe.execute_command('xack', 'inspectiondata', GROUP, *ids)
+    pipe.execute_command('xdel', 'inspectiondata', *ids)
+    pipe.execute()
+
+def run():
+    conn = connect_redis()
+    orderedXadd = conn.register_script(ORDERED_XADD)
+    gearconsumer.useBackend(conn.execute_command,
+                            lambda blob, count: runModel(conn, blob, count),
+                            lambda x, fields: publishPrediction(conn, orderedXadd, x, fields))
+    createGroup(conn)
+    print("Worker " + CONSUMER + " reading inspectiondata as part of " + GROUP)
+
+    lastClaim = 0
+    while True:
+        if time.monotonic() - lastClaim >= CLAIM_INTERVAL:
+            lastClaim = time.monotonic()
+            flushReorderBuffers(conn, orderedXadd)
+            claimed = claimEntries(conn)
+            if claimed:
+                processEntries(conn, claimed)
+                continue
+
+        res = conn.execute_command('xreadgroup', 'GROUP', GROUP, CONSUMER, 'COUNT', BATCH_SIZE, 'BLOCK', BLOCK_MS, 'STREAMS', 'inspectiondata', '>')
+        if res:
+            processEntries(conn, res[0][1])
+
+if __name__ == '__main__':
+    run()
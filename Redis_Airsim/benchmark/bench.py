@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+# the benchmark runs the code of the drone and of the gear from the repository as it is
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path += [os.path.join(HERE, '..', 'app'), os.path.join(HERE, '..', 'airsim')]
+
+import gearconsumer
+import havran
+from metrics import MetricsExporter
+from fakes import FakeAirSimClient, FakeMqttClient, RecordingRedis, CannedModel, LocalContainer
+
+# calls of every stage repeated under tracemalloc to find its peak memory, kept low as tracing slows everything down
+MEMORY_CALLS = 3
+# latencies growing by less than this many ms never count as a regression, they are within the noise of the timer
+REGRESSION_SLACK_MS = 0.1
+
+# latency percentiles in ms and throughput in items per second of the timed calls
+def summarize(latencies, items, elapsed):
+    ms = np.array(latencies) * 1000
+    return {'throughput': items / elapsed, 'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p99_ms': float(np.percentile(ms, 99))}
+
+# calls fn(i) count times, rate calls per second or as fast as possible when rate is 0, every call handles items items
+def measure(fn, count, rate=0, items=1):
+    latencies = []
+    start = time.perf_counter()
+    nextCall = start
+    for i in range(count):
+        if rate:
+            time.sleep(max(0, nextCall - time.perf_counter()))
+            nextCall += 1 / rate
+        callStart = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - callStart)
+    return summarize(latencies, count * items, time.perf_counter() - start)
+
+# peak memory in KiB allocated by a few calls of fn
+def peakMemory(fn, count=MEMORY_CALLS):
+    tracemalloc.start()
+    try:
+        for i in range(count):
+            fn(i)
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+# stream entry of the inspectiondata stream as the gear gets it
+def toRecord(fields, i, captureTime):
+    value = {k: v if isinstance(v, bytes) else str(v) for k, v in fields}
+    value.update({'imagename': 'bench_' + str(i) + '.jpg', 'inspectionId': 'bench', 'seq': str(i + 1), 'captureTime': repr(captureTime)})
+    return {'key': 'inspectiondata', 'id': str(i), 'value': value}
+
+def benchDrone(args, results):
+    client = FakeAirSimClient(args.width, args.height, args.encoding == 'png')
+    frames = []
+    records = []
+    results['capture'] = measure(lambda i: frames.append((havran.captureFrame(client, args.encoding == 'png'), time.time())), args.frames, args.fps)
+    results['capture']['peak_kb'] = peakMemory(lambda i: havran.captureFrame(client, args.encoding == 'png'))
+
+    encode = lambda i: records.append(toRecord(havran.encodeFrame(frames[i][0][0], args.encoding) + havran.poseFields(frames[i][0][1]), i, frames[i][1]))
+    results['encode'] = measure(encode, len(frames))
+    results['encode']['peak_kb'] = peakMemory(lambda i: havran.encodeFrame(frames[i][0][0], args.encoding))
+    return records
+
+def benchGear(args, results, records, blobDir):
+    redis = RecordingRedis()
+    model = CannedModel(args.model_ms / 1000)
+    gearconsumer.useBackend(redis.execute_command, model, lambda x, fields: redis.execute_command('xadd', 'predictions', '*', *fields))
+    gearconsumer.containerClient = LocalContainer(blobDir)
+    gearconsumer.CACHE_SIZE = args.cache_size
+
+    batches = [records[i:i + gearconsumer.BATCH_SIZE] for i in range(0, len(records), gearconsumer.BATCH_SIZE)]
+    predictions = []
+    results['predictImages'] = measure(lambda i: predictions.extend(gearconsumer.predictImages(batches[i])), len(batches), items=len(records) / len(batches))
+
+    results['addToStream'] = measure(lambda i: gearconsumer.addToStream(predictions[i]), len(predictions))
+    start = time.perf_counter()
+    gearconsumer.recordUploads(True)
+    results['uploadDrain'] = summarize([time.perf_counter() - start], 1, time.perf_counter() - start)
+
+    # the stages timed inside the gear, aggregated the same way the drones export them to influx
+    exporter = MetricsExporter(None, FakeMqttClient())
+    for entry in redis.streams.get('timings', []):
+        exporter.observe({str(k).encode(): str(v).encode() for k, v in entry.items()})
+    failed = sum(1 for entry in redis.streams.get('uploads', []) if entry['uploaded'] == '0')
+    modelled = model.images
+
+    results['predictImages']['peak_kb'] = peakMemory(lambda i: gearconsumer.predictImages(batches[i % len(batches)]))
+    results['addToStream']['peak_kb'] = peakMemory(lambda i: gearconsumer.addToStream(predictions[i]))
+    gearconsumer.recordUploads(True)
+    return {stage: histogram.fields() for stage, histogram in exporter.histograms.items()}, exporter.counters, failed, modelled
+
+def benchTelemetry(args, results):
+    client = FakeAirSimClient(samples=args.telemetry_samples)
+    mqtt = FakeMqttClient()
+    havran.connect_mqtt = lambda: mqtt
+    havran.getAirSimClient = lambda: client
+    havran.TELEMETRY_INTERVAL = 1 / args.telemetry_hz if args.telemetry_hz else 0
+    start = time.perf_counter()
+    havran.captureData()
+    elapsed = time.perf_counter() - start
+    # time of every sample without the sleep after it
+    latencies = np.maximum(np.diff(client.checks) - havran.TELEMETRY_INTERVAL, 0)
+    results['captureData'] = summarize(latencies, args.telemetry_samples, elapsed)
+    results['captureData']['mqtt_messages'] = mqtt.messages
+    client.samples = MEMORY_CALLS
+    results['captureData']['peak_kb'] = peakMemory(lambda i: havran.captureData(), 1)
+
+def benchFlight(args, results):
+    client = FakeAirSimClient(timeScale=args.time_scale)
+    fly = lambda i: havran.flyOverRectangleArea(client, havran.SURVEY_AREA, None, -args.altitude, 10)
+    results['flyOverRectangleArea'] = measure(fly, args.flights)
+    results['flyOverRectangleArea']['peak_kb'] = peakMemory(fly)
+    results['flyOverRectangleArea']['waypoints'] = client.waypoints / client.paths
+
+# stages whose latency grew or whose throughput fell by more than tolerance against the baseline
+def regressions(results, baseline, tolerance):
+    found = []
+    for stage, base in baseline.items():
+        current = results.get(stage)
+        if current is None:
+            continue
+        for key in ('p50_ms', 'p99_ms'):
+            if key in base and current[key] > base[key] * (1 + tolerance) + REGRESSION_SLACK_MS:
+                found.append(stage + ' ' + key + ' ' + str(round(base[key], 3)) + ' -> ' + str(round(current[key], 3)))
+        if 'throughput' in base and current['throughput'] < base['throughput'] * (1 - tolerance):
+            found.append(stage + ' throughput ' + str(round(base['throughput'], 1)) + ' -> ' + str(round(current['throughput'], 1)))
+    return found
+
+def printTable(results):
+    print(f"{'stage':<22}{'items/s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'peak KiB':>10}")
+    for stage, r in results.items():
+        print(f"{stage:<22}{r.get('throughput', float('nan')):>10.1f}{r['mean_ms']:>10.3f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r.get('peak_kb', float('nan')):>10.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the drone and gear pipeline offline with fake AirSim, RedisAI and Azure')
+    parser.add_argument('--frames', type=int, default=64, help='frames captured and sent through the gear')
+    parser.add_argument('--fps', type=float, default=0, help='capture rate, 0 captures as fast as possible')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--encoding', choices=['jpeg', 'raw', 'png'], default=havran.FRAME_ENCODING)
+    parser.add_argument('--model-ms', type=float, default=0, help='time the fake model takes per image')
+    parser.add_argument('--cache-size', type=int, default=gearconsumer.CACHE_SIZE, help='size of the inference cache, 0 turns it off')
+    parser.add_argument('--telemetry-samples', type=int, default=500)
+    parser.add_argument('--telemetry-hz', type=float, default=0, help='telemetry rate, 0 samples as fast as possible')
+    parser.add_argument('--flights', type=int, default=20, help='surveys planned and flown')
+    parser.add_argument('--altitude', type=float, default=20)
+    parser.add_argument('--time-scale', type=float, default=0, help='fraction of the real flight time the fake flight takes')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown against the baseline')
+    args = parser.parse_args()
+
+    results = {}
+    records = benchDrone(args, results)
+    with tempfile.TemporaryDirectory() as blobDir:
+        gearStages, counters, failed, modelled = benchGear(args, results, records, blobDir)
+    benchTelemetry(args, results)
+    benchFlight(args, results)
+
+    printTable(results)
+    print()
+    print("stages timed inside the gear (per frame)")
+    printTable(gearStages)
+    print()
+    print(f"frames {len(records)}, modelled {modelled}, cached {int(counters['cached'])}, failed uploads {failed}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(results, **{'gear.' + stage: r for stage, r in gearStages.items()}), f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(dict(results, **{'gear.' + stage: r for stage, r in gearStages.items()}), json.load(f), args.tolerance)
+        for regression in found:
+            print("regression: " + regression)
+        if found:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
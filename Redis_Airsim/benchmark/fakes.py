@@ -0,0 +1,149 @@
+import os
+import math
+import time
+import numpy as np
+import cv2
+
+# vector of AirSim with the fields the drone scripts read
+class Vector:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x_val = x
+        self.y_val = y
+        self.z_val = z
+
+    def get_length(self):
+        return math.sqrt(self.x_val ** 2 + self.y_val ** 2 + self.z_val ** 2)
+
+# quaternion of AirSim, w_val first as airsim.to_eularian_angles expects
+class Quaternion:
+    def __init__(self, w=1.0, x=0.0, y=0.0, z=0.0):
+        self.w_val = w
+        self.x_val = x
+        self.y_val = y
+        self.z_val = z
+
+class Record:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+# AirSim client flying a straight line at a constant speed and returning synthetic frames, every frame slides shift pixels
+# further over the ground, path calls take timeScale of the real flight time, 0 returns at once
+class FakeAirSimClient:
+    def __init__(self, width=640, height=480, compress=False, speed=10.0, altitude=20.0, samples=None, timeScale=0.0, shift=37, seed=0):
+        rng = np.random.default_rng(seed)
+        # a smooth random field, big enough to slide the frames over it while the drone moves
+        ground = rng.integers(0, 255, (height * 2, width * 2, 3), dtype=np.uint8)
+        self.ground = cv2.GaussianBlur(ground, (31, 31), 0)
+        self.width = width
+        self.height = height
+        self.compress = compress
+        self.speed = speed
+        self.altitude = altitude
+        # number of isApiControlEnabled calls answering True, None answers True forever
+        self.samples = samples
+        self.timeScale = timeScale
+        self.shift = shift
+        self.frames = 0
+        self.start = time.monotonic()
+        # times of the isApiControlEnabled calls, the telemetry loop makes one per sample
+        self.checks = []
+        self.paths = 0
+        self.waypoints = 0
+
+    def position(self):
+        return self.speed * (time.monotonic() - self.start)
+
+    def getMultirotorState(self, vehicle_name=''):
+        x = self.position()
+        kinematics = Record(position=Vector(x, 0.0, -self.altitude), linear_velocity=Vector(self.speed, 0.0, 0.0),
+                            linear_acceleration=Vector(), orientation=Quaternion())
+        gps = Record(latitude=47.641468 + math.degrees(x / 6378137.0), longitude=-122.140165, altitude=122.0 + self.altitude)
+        return Record(kinematics_estimated=kinematics, gps_location=gps)
+
+    def simGetImages(self, requests, vehicle_name=''):
+        self.frames += 1
+        offset = self.frames * self.shift % self.width
+        frame = np.ascontiguousarray(self.ground[:self.height, offset:offset + self.width])
+        if self.compress:
+            return [Record(image_data_uint8=cv2.imencode('.png', frame)[1].tobytes(), width=self.width, height=self.height)]
+        return [Record(image_data_uint8=frame.tobytes(), width=self.width, height=self.height)]
+
+    def simGetGroundTruthEnvironment(self, vehicle_name=''):
+        return Record(air_pressure=101325.0, temperature=15.0, air_density=1.225, gravity=Vector(0.0, 0.0, 9.81))
+
+    def getMagnetometerData(self, vehicle_name=''):
+        return Record(magnetic_field_body=Vector(0.2, 0.0, 0.4))
+
+    def isApiControlEnabled(self, vehicle=''):
+        self.checks.append(time.perf_counter())
+        if self.samples is None:
+            return True
+        self.samples -= 1
+        return self.samples >= 0
+
+    def moveOnPathAsync(self, path, velocity, vehicle_name=''):
+        length = sum(math.dist((a.x_val, a.y_val, a.z_val), (b.x_val, b.y_val, b.z_val)) for a, b in zip(path, path[1:]))
+        self.paths += 1
+        self.waypoints += len(path)
+        return Record(join=lambda: time.sleep(self.timeScale * length / velocity))
+
+# MQTT client keeping the size of what was published
+class FakeMqttClient:
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload):
+        self.messages += 1
+        self.bytes += len(payload)
+
+# redis of the gear, keeps the stream entries it was asked to add and answers everything else with nothing
+class RecordingRedis:
+    def __init__(self):
+        self.streams = {}
+        self.commands = 0
+
+    def execute_command(self, *args):
+        self.commands += 1
+        if str(args[0]).lower() == 'xadd':
+            fields = list(args[2:])
+            if str(fields[0]).upper() == 'MAXLEN':
+                fields = fields[3:]
+            fields = fields[1:]
+            self.streams.setdefault(args[1], []).append(dict(zip(fields[::2], fields[1::2])))
+        return None
+
+# model of RedisAI returning the same boxes for every image after delay seconds per image
+class CannedModel:
+    def __init__(self, delay=0.0, boxes=10):
+        self.delay = delay
+        rng = np.random.default_rng(1)
+        corners = rng.uniform(0, 0.8, (boxes, 2))
+        self.boxes = np.hstack([corners, corners + rng.uniform(0.05, 0.2, (boxes, 2))]).astype(np.float32)
+        self.scores = rng.uniform(0.2, 1.0, boxes).astype(np.float32)
+        self.classes = rng.integers(0, 6, boxes)
+        self.images = 0
+
+    def __call__(self, blob, count):
+        time.sleep(self.delay * count)
+        self.images += count
+        return (np.repeat(self.boxes[None], count, axis=0), np.repeat(self.scores[None], count, axis=0),
+                np.repeat(self.classes[None], count, axis=0))
+
+# Azure blob container writing the blobs to a local directory
+class LocalContainer:
+    def __init__(self, directory):
+        self.directory = directory
+        self.url = 'file://' + os.path.abspath(directory)
+        os.makedirs(directory, exist_ok=True)
+
+    def get_blob_client(self, name):
+        return LocalBlob(os.path.join(self.directory, name))
+
+class LocalBlob:
+    def __init__(self, path):
+        self.path = path
+
+    def upload_blob(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)